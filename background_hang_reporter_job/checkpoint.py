@@ -0,0 +1,122 @@
+import cPickle as pickle
+import gzip
+import os
+import tempfile
+import urlparse
+
+import boto3
+from boto3.s3.transfer import S3Transfer
+from botocore.exceptions import ClientError
+
+from background_hang_reporter_job.symbol_cache import make_dirs, remove_if_exists
+
+CHECKPOINT_VERSION = 2
+
+# Checkpoints are gzipped pickles of
+#   {'version': ..., 'job': ..., 'completedDates': set of "%Y%m%d" strings,
+#    'processor': ...}
+# where 'job' is a dict describing the run that wrote it (its window and the
+# settings its days were computed with) and 'processor' is
+# ProfileProcessor.get_state(). They live either on local disk or, for
+# s3://bucket/key paths, in S3.
+
+# The settings that change what etl_job ingests for a day. A checkpoint can
+# only be resumed by a job with the same ones.
+CHECKPOINT_JOB_KEYS = ['channel', 'sample_size', 'hang_lower_bound', 'hang_upper_bound',
+                       'stack_acceptance_threshold', 'hang_outlier_threshold',
+                       'post_sample_size']
+
+def get_checkpoint_job(config, profile_processor):
+    job = {k: config[k] for k in CHECKPOINT_JOB_KEYS}
+    job['start_date'] = config['start_date'].strftime("%Y%m%d")
+    job['end_date'] = config['end_date'].strftime("%Y%m%d")
+    job['tableLayout'] = profile_processor.get_table_layout()
+    return job
+
+def is_s3_path(path):
+    return path.startswith('s3://')
+
+def split_s3_path(path):
+    parsed = urlparse.urlparse(path)
+    return parsed.netloc, parsed.path.lstrip('/')
+
+def write_checkpoint_file(filename, job, completed_dates, processor_state):
+    with open(filename, 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=1) as gz:
+            pickle.dump({
+                'version': CHECKPOINT_VERSION,
+                'job': job,
+                'completedDates': completed_dates,
+                'processor': processor_state,
+            }, gz, pickle.HIGHEST_PROTOCOL)
+
+def read_checkpoint_file(filename):
+    with gzip.open(filename, 'rb') as f:
+        checkpoint = pickle.load(f)
+    if checkpoint.get('version') != CHECKPOINT_VERSION:
+        raise Exception('Unsupported checkpoint version: {}'.format(checkpoint.get('version')))
+    return checkpoint
+
+def save_checkpoint(path, job, completed_dates, processor_state):
+    if is_s3_path(path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.checkpoint')
+        os.close(fd)
+        try:
+            write_checkpoint_file(tmp_path, job, completed_dates, processor_state)
+            bucket, key = split_s3_path(path)
+            S3Transfer(boto3.client('s3', 'us-west-2')).upload_file(tmp_path, bucket, key)
+        finally:
+            remove_if_exists(tmp_path)
+        return
+
+    directory = os.path.dirname(os.path.abspath(path))
+    if not os.path.exists(directory):
+        make_dirs(directory)
+    # Write next to the old checkpoint and rename, so a failure while writing
+    # never leaves us without a usable one.
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    os.close(fd)
+    try:
+        write_checkpoint_file(tmp_path, job, completed_dates, processor_state)
+        os.rename(tmp_path, path)
+    except:
+        remove_if_exists(tmp_path)
+        raise
+
+def load_checkpoint(path, job):
+    # Returns None if there's no checkpoint yet. Raises if the checkpoint was
+    # written by a job other than `job`, rather than mixing their data.
+    checkpoint = load_checkpoint_file(path)
+    if checkpoint is not None and checkpoint['job'] != job:
+        mismatched = sorted(k for k in set(job) | set(checkpoint['job'])
+                            if job.get(k) != checkpoint['job'].get(k))
+        raise Exception('Checkpoint at {} was written by a different job (differs in {})'.format(
+            path, ', '.join(mismatched)))
+    return checkpoint
+
+def load_checkpoint_file(path):
+    if is_s3_path(path):
+        fd, tmp_path = tempfile.mkstemp(suffix='.checkpoint')
+        os.close(fd)
+        try:
+            bucket, key = split_s3_path(path)
+            try:
+                S3Transfer(boto3.client('s3', 'us-west-2')).download_file(bucket, key, tmp_path)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey'):
+                    return None
+                raise
+            return read_checkpoint_file(tmp_path)
+        finally:
+            remove_if_exists(tmp_path)
+
+    if not os.path.exists(path):
+        return None
+    return read_checkpoint_file(path)
+
+def delete_checkpoint(path):
+    if is_s3_path(path):
+        bucket, key = split_s3_path(path)
+        boto3.client('s3', 'us-west-2').delete_object(Bucket=bucket, Key=key)
+        return
+    remove_if_exists(path)
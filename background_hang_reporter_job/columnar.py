@@ -0,0 +1,116 @@
+from array import array
+
+class InternTable(object):
+    def __init__(self):
+        self.index_map = {}
+        self.values = []
+
+    def intern(self, value):
+        index = self.index_map.get(value)
+        if index is None:
+            index = len(self.values)
+            self.index_map[value] = index
+            self.values.append(value)
+        return index
+
+    def __getstate__(self):
+        # The index map is only needed while appending, and can be rebuilt.
+        return self.values
+
+    def __setstate__(self, values):
+        self.values = values
+        self.index_map = {v: i for i, v in enumerate(values)}
+
+class StackColumns(object):
+    # Stacks of (module, offset) frames, with modules and offsets interned, the
+    # frames stored as two parallel integer arrays and each stack a (start,
+    # length) slice of those.
+    def __init__(self):
+        self.modules = InternTable()
+        self.offsets = InternTable()
+        self.frame_modules = array('i')
+        self.frame_offsets = array('i')
+        self.starts = array('i')
+        self.lengths = array('i')
+
+    def append(self, stack):
+        self.starts.append(len(self.frame_modules))
+        self.lengths.append(len(stack))
+        for module, offset in stack:
+            self.frame_modules.append(self.modules.intern(module))
+            self.frame_offsets.append(self.offsets.intern(offset))
+
+    def get(self, i):
+        modules = self.modules.values
+        offsets = self.offsets.values
+        start = self.starts[i]
+        end = start + self.lengths[i]
+        return [(modules[self.frame_modules[j]], offsets[self.frame_offsets[j]])
+                for j in xrange(start, end)]
+
+    def iter_frames(self):
+        modules = self.modules.values
+        offsets = self.offsets.values
+        seen = set(zip(self.frame_modules, self.frame_offsets))
+        for module_index, offset_index in seen:
+            yield (modules[module_index], offsets[offset_index])
+
+class HangBlock(object):
+    """A batch of hangs, as produced by process_hangs, stored column-wise.
+
+    Stacks are stored as StackColumns, and the hangs' other strings (thread,
+    runnable name, process, build date and platform) are interned per block
+    into one integer array each. This pickles to a handful of flat buffers
+    instead of a deep graph of tuples.
+    """
+    def __init__(self):
+        self.stacks = StackColumns()
+        self.strings = InternTable()
+        self.durations = array('d')
+        self.string_columns = [array('i') for _ in xrange(5)]
+        self.annotations = []
+
+    def __len__(self):
+        return len(self.durations)
+
+    def append(self, hang):
+        stack, duration, thread, runnable_name, process, annotations, build_date, platform = hang
+        self.stacks.append(stack)
+        self.durations.append(duration)
+        for column, value in zip(self.string_columns,
+                                 (thread, runnable_name, process, build_date, platform)):
+            column.append(self.strings.intern(value))
+        self.annotations.append(annotations)
+
+    def get_stack(self, i):
+        return self.stacks.get(i)
+
+    def iter_hangs(self):
+        strings = self.strings.values
+        threads, runnable_names, processes, build_dates, platforms = self.string_columns
+        for i in xrange(len(self)):
+            yield (
+                self.get_stack(i),
+                self.durations[i],
+                strings[threads[i]],
+                strings[runnable_names[i]],
+                strings[processes[i]],
+                self.annotations[i],
+                strings[build_dates[i]],
+                strings[platforms[i]],
+            )
+
+    def iter_frames(self):
+        # Every distinct (module, offset) pair in the block, without materializing
+        # the stacks.
+        return self.stacks.iter_frames()
+
+def encode_hang_blocks(hangs, block_size):
+    block = HangBlock()
+    for hang in hangs:
+        block.append(hang)
+        if len(block) >= block_size:
+            yield block
+            block = HangBlock()
+    if len(block):
+        yield block
@@ -1,27 +1,27 @@
-
-import contextlib
 import gc
-import gzip
-import os
 import time
-import urllib
-import urllib2
 import uuid
-from bisect import bisect
 from datetime import datetime, timedelta
-from StringIO import StringIO
+from multiprocessing.pool import ThreadPool
 
-import ujson as json
-import boto3
-from boto3.s3.transfer import S3Transfer
 from moztelemetry import get_pings_properties
 from moztelemetry.dataset import Dataset
-
-from background_hang_reporter_job.profile import ProfileProcessor
-from background_hang_reporter_job.tracked import get_tracked_stats
+from pyspark import StorageLevel
+
+from background_hang_reporter_job.checkpoint import (CHECKPOINT_JOB_KEYS, delete_checkpoint,
+                                                     get_checkpoint_job, load_checkpoint,
+                                                     save_checkpoint)
+from background_hang_reporter_job.columnar import encode_hang_blocks
+from background_hang_reporter_job.profile import (ProfileProcessor, assemble_profile,
+                                                  merge_number_dicts)
+from background_hang_reporter_job.storage import (evict_incremental_files, file_exists,
+                                                  ingest_file_lazily, read_file, read_job_file,
+                                                  write_file, write_job_file)
+from background_hang_reporter_job.symbolication import (UNSYMBOLICATED, KnownSymbols,
+                                                        process_modules)
+from background_hang_reporter_job.tracked import get_tracked_stats, TrackedStatMatcher
 import background_hang_reporter_job.crashes as crashes
 
-UNSYMBOLICATED = "<unsymbolicated>"
 REDUCE_BY_KEY_PARALLELISM = 4001
 
 def time_code(name, callback):
@@ -33,6 +33,69 @@ def time_code(name, callback):
     print "{} took {}ms to complete".format(name, int(round(delta * 1000)))
     return result
 
+def persist_rdd(rdd, config):
+    # Keeps an RDD that several stages consume from being recomputed (and its
+    # pings re-read from S3) for each of them.
+    storage_level = config['intermediate_storage_level']
+    if storage_level is None:
+        return rdd
+    print "Persisting RDD {} with {}".format(rdd.id(), storage_level)
+    return rdd.persist(getattr(StorageLevel, storage_level))
+
+def unpersist_rdds(*rdds):
+    for rdd in rdds:
+        if rdd.is_cached:
+            rdd.unpersist()
+
+def get_ping_properties(config):
+    if config['exclude_modules']:
+        return ["environment/system/os/name",
+                "environment/system/os/version",
+                "application/architecture",
+                "application/buildId",
+                "payload/hangs",
+                "payload/timeSinceLastPing"]
+    return ["environment/system/os/name",
+            "environment/system/os/version",
+            "application/architecture",
+            "application/buildId",
+            "payload/modules",
+            "payload/hangs",
+            "payload/timeSinceLastPing"]
+
+def get_property_alias(prop):
+    return prop.replace('/', '_')
+
+def use_fused_decoding(config):
+    # crashes.get_data already returns flattened properties, which can only go
+    # through the properties path.
+    return config['fused_ping_decoding'] and not config['TMP_use_crashes']
+
+def get_data_pushdown(sc, config, date_str, end_date_str, properties):
+    # Only lists the bhr partitions, skipping submission dates before the first
+    # build we want, and only decodes the properties we use. Returns None if the
+    # dataset can't do that, so get_data can fall back to filtering OTHER pings.
+    dataset = (Dataset.from_source("telemetry")
+               .where(submissionDate=lambda s: s >= date_str)
+               .where(docType='bhr')
+               .where(appBuildId=lambda b: b[:8] >= date_str and b[:8] <= end_date_str)
+               .where(appUpdateChannel=config['channel']))
+    if not dataset.summaries(sc, limit=1):
+        print "No bhr partitions found, not pushing down ping loading"
+        return None
+
+    if use_fused_decoding(config):
+        # get_valid_pings decodes the raw pings itself.
+        return dataset.records(sc, sample=config['sample_size'])
+
+    if not hasattr(dataset, 'select'):
+        print "Dataset.select isn't available, not pushing down ping loading"
+        return None
+    selected = {get_property_alias(p): p.replace('/', '.') for p in properties}
+    records = dataset.select(**selected).records(sc, sample=config['sample_size'])
+    # Same shape as get_pings_properties' output.
+    return records.map(lambda r: {p: r.get(get_property_alias(p)) for p in properties})
+
 def get_data(sc, config, date, end_date=None):
     if config['TMP_use_crashes']:
         return crashes.get_data(sc, config, date)
@@ -42,6 +105,12 @@ def get_data(sc, config, date, end_date=None):
 
     date_str = date.strftime("%Y%m%d")
     end_date_str = end_date.strftime("%Y%m%d")
+    properties = get_ping_properties(config)
+
+    if config['pushdown_ping_loading']:
+        pings = get_data_pushdown(sc, config, date_str, end_date_str, properties)
+        if pings is not None:
+            return pings
 
     pings = (Dataset.from_source("telemetry")
              .where(docType='OTHER')
@@ -50,22 +119,8 @@ def get_data(sc, config, date, end_date=None):
              .records(sc, sample=config['sample_size']))
 
     pings = pings.filter(lambda p: p.get('meta', {}).get('docType', {}) == 'bhr')
-
-    if config['exclude_modules']:
-        properties = ["environment/system/os/name",
-                      "environment/system/os/version",
-                      "application/architecture",
-                      "application/buildId",
-                      "payload/hangs",
-                      "payload/timeSinceLastPing"]
-    else:
-        properties = ["environment/system/os/name",
-                      "environment/system/os/version",
-                      "application/architecture",
-                      "application/buildId",
-                      "payload/modules",
-                      "payload/hangs",
-                      "payload/timeSinceLastPing"]
+    if use_fused_decoding(config):
+        return pings
 
     try:
         return get_pings_properties(pings, properties, with_processes=True)
@@ -92,20 +147,12 @@ def process_frame(frame, modules):
     else:
         return (('pseudo', None), frame)
 
-def process_hangs(ping):
-    build_date = ping["application/buildId"][:8] # "YYYYMMDD" : 8 characters
-
-    os_version_split = ping["environment/system/os/version"].split('.')
+def get_platform(os_name, os_version, architecture):
+    os_version_split = os_version.split('.')
     os_version = os_version_split[0] if len(os_version_split) > 0 else ""
-    platform = "{}:{}:{}".format(ping["environment/system/os/name"],
-                                 os_version,
-                                 ping["application/architecture"])
-
-    modules = ping.get('payload/modules', [])
-    hangs = ping['payload/hangs']
-    if hangs is None:
-        return []
+    return "{}:{}:{}".format(os_name, os_version, architecture)
 
+def make_hang_tuples(hangs, modules, build_date, platform):
     return [(
         [process_frame(frame, modules) for frame in h['stack']],
         h['duration'],
@@ -117,8 +164,87 @@ def process_hangs(ping):
         platform,
     ) for h in hangs]
 
-def get_all_hangs(pings):
-    return pings.flatMap(process_hangs)
+def process_hangs(ping):
+    build_date = ping["application/buildId"][:8] # "YYYYMMDD" : 8 characters
+    platform = get_platform(ping["environment/system/os/name"],
+                            ping["environment/system/os/version"],
+                            ping["application/architecture"])
+
+    modules = ping.get('payload/modules', [])
+    hangs = ping['payload/hangs']
+    if hangs is None:
+        return []
+
+    return make_hang_tuples(hangs, modules, build_date, platform)
+
+def get_dict(obj, key):
+    value = obj.get(key)
+    return value if isinstance(value, dict) else {}
+
+def decode_ping(ping, exclude_modules):
+    # Validates a raw ping and turns it into ((build_date, usage_hours), hangs)
+    # in one go, equivalent to get_pings_properties, ping_is_valid,
+    # get_usage_hours and process_hangs. Returns None for invalid pings.
+    os_info = get_dict(get_dict(get_dict(ping, 'environment'), 'system'), 'os')
+    application = get_dict(ping, 'application')
+    payload = get_dict(ping, 'payload')
+
+    os_name = os_info.get('name')
+    os_version = os_info.get('version')
+    build_id = application.get('buildId')
+    time_since_last_ping = payload.get('timeSinceLastPing')
+    if not isinstance(os_version, basestring):
+        return None
+    if not isinstance(os_name, basestring):
+        return None
+    if not isinstance(build_id, basestring):
+        return None
+    if not isinstance(time_since_last_ping, int):
+        return None
+
+    build_date = build_id[:8] # "YYYYMMDD" : 8 characters
+    usage_hours = (build_date, float(time_since_last_ping) / 3600000.0)
+
+    hangs = payload.get('hangs')
+    if hangs is None:
+        return usage_hours, []
+
+    modules = [] if exclude_modules else payload.get('modules')
+    platform = get_platform(os_name, os_version, application.get('architecture'))
+    return usage_hours, make_hang_tuples(hangs, modules, build_date, platform)
+
+def decode_pings_partition(pings, exclude_modules):
+    for ping in pings:
+        decoded = decode_ping(ping, exclude_modules)
+        if decoded is not None:
+            yield decoded
+
+def get_valid_pings(pings, config):
+    # With fused_ping_decoding, pings are raw and each valid one is decoded into
+    # a (usage hours, hangs) pair here.
+    if use_fused_decoding(config):
+        exclude_modules = config['exclude_modules']
+        return pings.mapPartitions(lambda partition: decode_pings_partition(partition,
+                                                                            exclude_modules))
+    return pings.filter(ping_is_valid)
+
+def get_all_hangs(pings, config, columnar=True):
+    # Callers that consume each hang only once pass columnar=False: encoding is
+    # only worth it for hangs that are persisted and read several times.
+    if use_fused_decoding(config):
+        hangs = pings.flatMap(lambda decoded: decoded[1])
+    else:
+        hangs = pings.flatMap(process_hangs)
+    if columnar and config['columnar_hangs']:
+        block_size = config['columnar_hang_block_size']
+        return hangs.mapPartitions(lambda partition: encode_hang_blocks(partition, block_size))
+    return hangs
+
+def get_hang_tuples(hangs, config):
+    # Turns the output of get_all_hangs back into process_hangs tuples.
+    if config['columnar_hangs']:
+        return hangs.flatMap(lambda block: block.iter_hangs())
+    return hangs
 
 def map_to_frame_info(hang):
     memory_map = hang['hang']['nativeStack']['memoryMap']
@@ -128,8 +254,12 @@ def map_to_frame_info(hang):
         for module_index, offset in stack
     ]
 
-def get_frames_by_module(hangs):
-    return (hangs.flatMap(lambda hang: hang[0])
+def get_frames_by_module(hangs, config):
+    if config['columnar_hangs']:
+        frames = hangs.flatMap(lambda block: block.iter_frames())
+    else:
+        frames = hangs.flatMap(lambda hang: hang[0])
+    return (frames
             .filter(lambda hang_tuple: hang_tuple[0] is not None)
             .map(lambda hang_tuple: (hang_tuple[0], (hang_tuple[1],)))
             .distinct()
@@ -202,16 +332,37 @@ def process_hang_value(key, val, usage_hours_by_date):
     stack, runnable_name, thread, build_date, pending_input, platform = key
     return (val[0] / usage_hours_by_date[build_date], val[1] / usage_hours_by_date[build_date])
 
+def get_hang_data(hangs, config):
+    return (get_hang_tuples(hangs, config)
+            .map(lambda hang: map_to_hang_data(hang, config))
+            .filter(lambda hang: hang is not None))
+
+def get_symbolicated_rows(hangs, broadcast_modules, usage_hours_by_date, config):
+    # Symbolicating before the reduce collapses stacks that only differ by
+    # return addresses within the same functions, shrinking both the shuffle
+    # and whatever is collected afterwards. The rows are in the format
+    # ProfileProcessor.ingest expects.
+    return (get_hang_data(hangs, config)
+            .map(lambda x: (process_hang_key(x[0], broadcast_modules.value), x[1]))
+            .reduceByKey(merge_hang_data, REDUCE_BY_KEY_PARALLELISM)
+            .map(lambda x: x[0] + process_hang_value(x[0], x[1], usage_hours_by_date)))
+
 def get_grouped_sums_and_counts(hangs, processed_modules, usage_hours_by_date, config):
-    reduced = (hangs
-               .map(lambda hang: map_to_hang_data(hang, config))
-               .filter(lambda hang: hang is not None)
-               .reduceByKey(merge_hang_data, REDUCE_BY_KEY_PARALLELISM)
-               .collect())
-    items = [
-        (process_hang_key(k, processed_modules), process_hang_value(k, v, usage_hours_by_date))
-        for k, v in reduced
-    ]
+    if config['symbolicate_on_executors']:
+        broadcast_modules = hangs.context.broadcast(processed_modules)
+        try:
+            return get_symbolicated_rows(hangs, broadcast_modules,
+                                         usage_hours_by_date, config).collect()
+        finally:
+            broadcast_modules.unpersist()
+    else:
+        reduced = (get_hang_data(hangs, config)
+                   .reduceByKey(merge_hang_data, REDUCE_BY_KEY_PARALLELISM)
+                   .collect())
+        items = [
+            (process_hang_key(k, processed_modules), process_hang_value(k, v, usage_hours_by_date))
+            for k, v in reduced
+        ]
     return [
         k + v for k, v in items if k is not None
     ]
@@ -224,97 +375,62 @@ def get_usage_hours(ping):
 def merge_usage_hours(a, b):
     return a + b
 
-def get_usage_hours_by_date(pings):
-    return (pings.map(get_usage_hours)
+def get_usage_hours_by_date(pings, config):
+    if use_fused_decoding(config):
+        usage_hours = pings.map(lambda decoded: decoded[0])
+    else:
+        usage_hours = pings.map(get_usage_hours)
+    return (usage_hours
             .reduceByKey(merge_usage_hours, REDUCE_BY_KEY_PARALLELISM)
             .collectAsMap())
 
-def make_sym_map(data):
-    public_symbols = {}
-    func_symbols = {}
-
-    for line in data.splitlines():
-        if line.startswith("PUBLIC "):
-            line = line.rstrip()
-            fields = line.split(" ", 3)
-            if len(fields) < 4:
-                continue
-            address = int(fields[1], 16)
-            symbol = fields[3]
-            public_symbols[address] = symbol
-        elif line.startswith("FUNC "):
-            line = line.rstrip()
-            fields = line.split(" ", 4)
-            if len(fields) < 5:
-                continue
-            address = int(fields[1], 16)
-            symbol = fields[4]
-            func_symbols[address] = symbol
-    # Prioritize PUBLIC symbols over FUNC ones
-    sym_map = func_symbols
-    sym_map.update(public_symbols)
-
-    return sorted(sym_map), sym_map
-
-def get_file_URL(module, config):
-    lib_name, breakpad_id = module
-    if lib_name is None or breakpad_id is None:
-        return None
-    if lib_name.endswith(".pdb"):
-        file_name = lib_name[:-4] + ".sym"
-    else:
-        file_name = lib_name + ".sym"
+# Tags for the records of get_hangs_with_usage.
+HANG_RECORD = 0
+USAGE_RECORD = 1
 
-    try:
-        return config['symbol_server_url'] + "/".join([
-            urllib.quote_plus(lib_name),
-            urllib.quote_plus(breakpad_id),
-            urllib.quote_plus(file_name)
-        ])
-    except KeyError:
-        # urllib throws with unicode strings. TODO: investigate why
-        # any of these values (lib_name, breakpad_id, file_name) would
-        # have unicode strings, or if this is just bad pings.
+def decode_valid_ping(ping, config):
+    if use_fused_decoding(config):
+        return decode_ping(ping, config['exclude_modules'])
+    if not ping_is_valid(ping):
         return None
-
-def process_module(module, offsets, config):
-    result = []
-    if module[0] == 'pseudo':
-        return [((None, offset), (offset, '')) for offset in offsets]
-    file_URL = get_file_URL(module, config)
-    module_name, breakpad_id = module
-    if file_URL:
-        success, response = fetch_URL(file_URL)
-    else:
-        success = False
-
-    if success:
-        sorted_keys, sym_map = make_sym_map(response)
-
-        for offset in offsets:
-            i = bisect(sorted_keys, int(offset, 16))
-            key = sorted_keys[i - 1] if i else None
-
-            symbol = sym_map.get(key)
-            if symbol is not None:
-                result.append(((breakpad_id, offset), (symbol, module_name)))
-            else:
-                result.append(((breakpad_id, offset), (UNSYMBOLICATED, module_name)))
-    else:
-        for offset in offsets:
-            result.append(((breakpad_id, offset), (UNSYMBOLICATED, module_name)))
-    return result
-
-def process_modules(sc, frames_by_module, config):
-    data = sc.parallelize(frames_by_module.iteritems())
-    return data.flatMap(lambda x: process_module(x[0], x[1], config)).collectAsMap()
+    return get_usage_hours(ping), process_hangs(ping)
+
+def decode_partition_with_usage(pings, config, columnar):
+    usage_hours_by_date = {}
+    def iter_hangs():
+        for ping in pings:
+            decoded = decode_valid_ping(ping, config)
+            if decoded is None:
+                continue
+            (build_date, usage_hours), hangs = decoded
+            usage_hours_by_date[build_date] = usage_hours_by_date.get(build_date, 0.0) + usage_hours
+            for hang in hangs:
+                yield hang
+
+    hangs = iter_hangs()
+    if columnar and config['columnar_hangs']:
+        hangs = encode_hang_blocks(hangs, config['columnar_hang_block_size'])
+    for hang in hangs:
+        yield (HANG_RECORD, hang)
+    # Only complete once every hang in the partition has been yielded.
+    yield (USAGE_RECORD, usage_hours_by_date)
+
+def get_hangs_with_usage(pings, config, columnar=True):
+    # One pass over the pings producing both what get_all_hangs would, tagged
+    # HANG_RECORD, and each partition's usage hours by build date, tagged
+    # USAGE_RECORD.
+    return pings.mapPartitions(lambda partition: decode_partition_with_usage(partition, config,
+                                                                             columnar))
+
+def get_tagged_records(records, tag):
+    return records.filter(lambda record: record[0] == tag).map(lambda record: record[1])
 
 def map_to_histogram(hang):
     #pylint: disable=unused-variable
     stack, duration, thread, runnable_name, process, annotations, build_date, platform = hang
     hist = [0] * 8
     if duration < 128:
-        return (build_date, hist)
+        return ((build_date, thread), hist)
     bucket = min(7, int(duration).bit_length() - 8) # 128 will give a bit length of 8
     hist[bucket] = 1
     return ((build_date, thread), hist)
@@ -322,153 +438,183 @@ def map_to_histogram(hang):
 def reduce_histograms(a, b):
     return [a_bucket + b_bucket for a_bucket, b_bucket in zip(a, b)]
 
-def count_hangs_in_pings(_, pings, tracked):
-    filtered = time_code("Filtering to valid pings",
-                         lambda: pings.filter(ping_is_valid))
-
-    hangs = time_code("Filtering to hangs with native stacks",
-                      lambda: get_all_hangs(filtered))
-
-    usage_hours_by_date = time_code("Getting usage hours",
-                                    lambda: get_usage_hours_by_date(filtered))
+def map_to_tracked_histograms(hang, matcher):
+    (build_date, thread), hist = map_to_histogram(hang)
+    return [
+        ((stat_index, build_date, thread), hist)
+        for stat_index in matcher.matching_stats(hang)
+    ]
 
-    histograms_by_type = []
-    for tracked_stat in tracked:
-        filtered = hangs.filter(tracked_stat.matches_hang)
-        histograms_by_date_and_thread = (filtered.map(map_to_histogram)
-                                         .reduceByKey(reduce_histograms, REDUCE_BY_KEY_PARALLELISM)
-                                         .collectAsMap())
+def map_to_tracked_histograms_and_usage(record, matcher):
+    tag, value = record
+    if tag == USAGE_RECORD:
+        return [((None, build_date), usage_hours)
+                for build_date, usage_hours in value.iteritems()]
+    return map_to_tracked_histograms(value, matcher)
+
+def reduce_histograms_and_usage(a, b):
+    if isinstance(a, float):
+        return a + b
+    return reduce_histograms(a, b)
+
+def get_tracked_histograms_and_usage(pings, matcher, config):
+    # Usage hours are keyed by (None, build_date) and go through the same
+    # reduceByKey as the (stat_index, build_date, thread) histograms.
+    reduced = (get_hangs_with_usage(pings, config, columnar=False)
+               .flatMap(lambda record: map_to_tracked_histograms_and_usage(record, matcher))
+               .reduceByKey(reduce_histograms_and_usage, REDUCE_BY_KEY_PARALLELISM)
+               .collectAsMap())
+    usage_hours_by_date = {}
+    histograms = {}
+    for k, v in reduced.iteritems():
+        if k[0] is None:
+            usage_hours_by_date[k[1]] = v
+        else:
+            histograms[k] = v
+    return usage_hours_by_date, histograms
 
-        histograms_by_thread = {}
-        for k, histogram in histograms_by_date_and_thread.iteritems():
-            build_date, thread = k
-            usage_hours = usage_hours_by_date[build_date]
-            if thread not in histograms_by_thread:
-                histograms_by_thread[thread] = {}
-            histograms_by_thread[thread][build_date] = [float(bucket) / usage_hours for bucket in histogram]
+def count_hangs_in_pings(_, pings, tracked, config):
+    # Evaluate every tracked stat against each hang in a single pass over the data.
+    matcher = TrackedStatMatcher(tracked)
 
-        histograms_by_type.append((tracked_stat.title, histograms_by_thread))
+    filtered = None
+    try:
+        if config['single_pass_usage_hours']:
+            usage_hours_by_date, histograms_by_stat_date_and_thread = time_code(
+                "Computing tracked histograms and usage hours",
+                lambda: get_tracked_histograms_and_usage(pings, matcher, config))
+        else:
+            filtered = time_code("Filtering to valid pings",
+                                 lambda: persist_rdd(get_valid_pings(pings, config), config))
+
+            # The hangs are only read once, so they're neither persisted nor encoded.
+            hangs = get_all_hangs(filtered, config, columnar=False)
+
+            usage_hours_by_date = time_code("Getting usage hours",
+                                            lambda: get_usage_hours_by_date(filtered, config))
+
+            histograms_by_stat_date_and_thread = time_code(
+                "Computing tracked histograms",
+                lambda: (hangs.flatMap(lambda hang: map_to_tracked_histograms(hang, matcher))
+                         .reduceByKey(reduce_histograms, REDUCE_BY_KEY_PARALLELISM)
+                         .collectAsMap()))
+    finally:
+        if filtered is not None:
+            unpersist_rdds(filtered)
+
+    histograms_by_type = [(tracked_stat.title, {}) for tracked_stat in tracked]
+    for k, histogram in histograms_by_stat_date_and_thread.iteritems():
+        stat_index, build_date, thread = k
+        histograms_by_thread = histograms_by_type[stat_index][1]
+        usage_hours = usage_hours_by_date[build_date]
+        if thread not in histograms_by_thread:
+            histograms_by_thread[thread] = {}
+        histograms_by_thread[thread][build_date] = [float(bucket) / usage_hours for bucket in histogram]
 
     return histograms_by_type
 
-def transform_pings(sc, pings, config):
-    filtered = time_code("Filtering to valid pings",
-                         lambda: pings.filter(ping_is_valid))
+def get_hangs_and_symbols(sc, pings, config, known_symbols=None):
+    if config['single_pass_usage_hours']:
+        # The pings are read once, and only the decoded hangs and per-partition
+        # usage hours are kept around.
+        filtered = time_code("Filtering to hangs with native stacks",
+                             lambda: persist_rdd(get_hangs_with_usage(pings, config), config))
+        hangs = get_tagged_records(filtered, HANG_RECORD)
+    else:
+        filtered = time_code("Filtering to valid pings",
+                             lambda: persist_rdd(get_valid_pings(pings, config), config))
 
-    hangs = time_code("Filtering to hangs with native stacks",
-                      lambda: get_all_hangs(filtered))
+        hangs = time_code("Filtering to hangs with native stacks",
+                          lambda: persist_rdd(get_all_hangs(filtered, config), config))
 
-    frames_by_module = time_code("Getting stacks by module",
-                                 lambda: get_frames_by_module(hangs))
+    try:
+        frames_by_module = time_code("Getting stacks by module",
+                                     lambda: get_frames_by_module(hangs, config))
 
-    processed_modules = time_code("Processing modules",
-                                  lambda: process_modules(sc, frames_by_module, config))
+        if known_symbols is None:
+            processed_modules = time_code("Processing modules",
+                                          lambda: process_modules(sc, frames_by_module, config))
+        else:
+            processed_modules = time_code("Processing modules",
+                                          lambda: known_symbols.process_modules(
+                                              sc, frames_by_module, config))
+
+        if config['single_pass_usage_hours']:
+            usage_hours_by_date = time_code(
+                "Getting usage hours",
+                lambda: get_tagged_records(filtered, USAGE_RECORD).fold({}, merge_number_dicts))
+        else:
+            usage_hours_by_date = time_code("Getting usage hours",
+                                            lambda: get_usage_hours_by_date(filtered, config))
+    except:
+        unpersist_rdds(filtered, hangs)
+        raise
 
-    usage_hours_by_date = time_code("Getting usage hours",
-                                    lambda: get_usage_hours_by_date(filtered))
+    return filtered, hangs, processed_modules, usage_hours_by_date
 
-    result = time_code("Grouping stacks",
-                       lambda: get_grouped_sums_and_counts(hangs,
-                                                           processed_modules,
-                                                           usage_hours_by_date, config))
-    return result, usage_hours_by_date
+def transform_pings(sc, pings, config, known_symbols=None):
+    filtered, hangs, processed_modules, usage_hours_by_date = get_hangs_and_symbols(
+        sc, pings, config, known_symbols)
 
-def fetch_URL(url):
-    result = False, ""
     try:
-        with contextlib.closing(urllib2.urlopen(url)) as response:
-            #pylint: disable=no-member
-            responseCode = response.getcode()
-            if responseCode == 404:
-                return False, ""
-            if responseCode != 200:
-                result = False, ""
-            return True, decode_response(response)
-    except IOError:
-        result = False, ""
-
-    if not result[0]:
-        try:
-            with contextlib.closing(urllib2.urlopen(url)) as response:
-                #pylint: disable=no-member
-                responseCode = response.getcode()
-                if responseCode == 404:
-                    return False, ""
-                if responseCode != 200:
-                    result = False, ""
-                return True, decode_response(response)
-        except IOError:
-            result = False, ""
-
-    return result
-
-def decode_response(response):
-    headers = response.info()
-    content_encoding = headers.get("Content-Encoding", "").lower()
-    if content_encoding in ("gzip", "x-gzip", "deflate"):
-        with contextlib.closing(StringIO(response.read())) as data_stream:
-            try:
-                with gzip.GzipFile(fileobj=data_stream) as f:
-                    return f.read()
-            except EnvironmentError:
-                #pylint: disable=no-member
-                data_stream.seek(0)
-                #pylint: disable=no-member
-                return data_stream.read().decode('zlib')
-    return response.read()
-
-def read_file(name, config):
-    end_date = datetime.today()
-    end_date_str = end_date.strftime("%Y%m%d")
-
-    if config['read_files_from_network']:
-        s3_key = "bhr/data/hang_aggregates/" + name + ".json"
-        url = config['analysis_output_url'] + s3_key
-        success, response = fetch_URL(url)
-        if not success:
-            raise Exception('Could not find file at url: ' + url)
-        return json.loads(response)
-    else:
-        if config['append_date']:
-            filename = "./output/%s-%s.json" % (name, end_date_str)
-        else:
-            filename = "./output/%s.json" % name
-        gzfilename = filename + '.gz'
-        with gzip.open(gzfilename, 'r') as f:
-            return json.loads(f.read())
+        result = time_code("Grouping stacks",
+                           lambda: get_grouped_sums_and_counts(hangs,
+                                                               processed_modules,
+                                                               usage_hours_by_date, config))
+    finally:
+        unpersist_rdds(filtered, hangs)
+    return result, usage_hours_by_date
 
-def write_file(name, stuff, config):
-    end_date = datetime.today()
-    end_date_str = end_date.strftime("%Y%m%d")
+def transform_pings_distributed(sc, pings, config, known_symbols=None):
+    # Like transform_pings, but leaves the grouped rows in a persisted RDD
+    # rather than collecting them to the driver.
+    filtered, hangs, processed_modules, usage_hours_by_date = get_hangs_and_symbols(
+        sc, pings, config, known_symbols)
 
-    if config['append_date']:
-        filename = "./output/%s-%s.json" % (name, end_date_str)
-    else:
-        filename = "./output/%s.json" % name
-    gzfilename = filename + '.gz'
-    jsonblob = json.dumps(stuff, ensure_ascii=False)
-
-    if not os.path.exists('./output'):
-        os.makedirs('./output')
-    with gzip.open(gzfilename, 'w') as f:
-        f.write(jsonblob)
-
-    if config['use_s3']:
-        bucket = "telemetry-public-analysis-2"
-        s3_key = "bhr/data/hang_aggregates/" + name + ".json"
-        client = boto3.client('s3', 'us-west-2')
-        transfer = S3Transfer(client)
-        extra_args = {'ContentType':'application/json', 'ContentEncoding':'gzip'}
-        transfer.upload_file(gzfilename,
-                             bucket,
-                             s3_key,
-                             extra_args=extra_args)
-        if config['uuid'] is not None:
-            s3_uuid_key = "bhr/data/hang_aggregates/" + name + "_" + config['uuid'] + ".json"
-            transfer.upload_file(gzfilename,
-                                 bucket,
-                                 s3_uuid_key,
-                                 extra_args=extra_args)
+    broadcast_modules = sc.broadcast(processed_modules)
+    try:
+        rows = persist_rdd(get_symbolicated_rows(hangs, broadcast_modules,
+                                                 usage_hours_by_date, config), config)
+        # Only materialize the rows now if they're persisted, so that filtered
+        # and hangs can be released. Otherwise they're computed when consumed.
+        if config['intermediate_storage_level'] is not None:
+            row_count = time_code("Grouping stacks", rows.count)
+            print "{} grouped stacks".format(row_count)
+    finally:
+        # Executors drop their copies; if the rows are recomputed later, the
+        # modules are sent to them again.
+        broadcast_modules.unpersist()
+        unpersist_rdds(filtered, hangs)
+    return rows, usage_hours_by_date
+
+def process_thread_partition(rows, config):
+    rows_by_day = {}
+    for _, (day, row) in rows:
+        rows_by_day.setdefault(day, []).append(row)
+    profile_processor = ProfileProcessor(config)
+    for day in sorted(rows_by_day):
+        profile_processor.ingest(rows_by_day[day], {})
+    return profile_processor.process_threads()
+
+def tag_rows(rows, day):
+    return rows.map(lambda row: (row[2], (day, row)))
+
+def process_profile_distributed(rows_by_day, usage_hours_by_date, config):
+    # Every row for a given thread lands in the same partition, so each
+    # partition can build its threads' tables independently, and the driver
+    # only collects the finished threads. Each partition ingests the days one
+    # at a time and in order, so stacks are pruned just as when the driver
+    # ingests each day's rows.
+    tagged = [tag_rows(rows, day) for day, rows in enumerate(rows_by_day)]
+    try:
+        processed_threads = (rows_by_day[0].context.union(tagged)
+                             .partitionBy(config['profile_thread_partitions'])
+                             .mapPartitions(lambda partition: process_thread_partition(partition,
+                                                                                       config))
+                             .collect())
+    finally:
+        unpersist_rdds(*rows_by_day)
+    return assemble_profile(processed_threads, usage_hours_by_date, config)
 
 default_config = {
     'start_date': datetime.today() - timedelta(days=9),
@@ -476,6 +622,25 @@ default_config = {
     'use_s3': True,
     'sample_size': 0.50,
     'symbol_server_url': "https://s3-us-west-2.amazonaws.com/org.mozilla.crash-stats.symbols-public/v1/",
+    # Directory for parsed symbol files, shared by every task on a machine. None disables it.
+    'symbol_cache_dir': None,
+    'symbol_cache_max_bytes': 10 * 1024 * 1024 * 1024,
+    # Resolve offsets while downloading .sym files rather than parsing them whole.
+    # Only used when symbol_cache_dir is None.
+    'streaming_symbolication': False,
+    # Number of symbol files fetched at once within each partition.
+    'symbol_fetch_concurrency': 16,
+    'symbol_fetch_timeout': 60,
+    'symbol_fetch_retries': 3,
+    'symbol_fetch_backoff': 0.5,
+    # How long a 404 from the symbol server is remembered. Needs symbol_cache_dir.
+    'symbol_missing_ttl': 7 * 24 * 60 * 60,
+    # Stop requesting symbols for a while once half of the last 50 requests failed.
+    'symbol_breaker_window': 50,
+    'symbol_breaker_error_rate': 0.5,
+    'symbol_breaker_cooldown': 60,
+    # Number of symbolicated frames the driver remembers between days.
+    'known_symbols_max_entries': 1000000,
     'hang_profile_in_filename': 'hang_profile_128_16000',
     'hang_profile_out_filename': None,
     'print_debug_info': False,
@@ -489,12 +654,81 @@ default_config = {
     'read_files_from_network': False,
     'split_threads_in_out_file': False,
     'use_minimal_sample_table': False,
+    # Keep the integer columns of the func, stack and sample tables in typed arrays.
+    'use_typed_tables': False,
+    # Build the whole weighted call tree while ingesting and prune it once at the
+    # end, instead of pruning each sample against the weights seen so far.
+    'deferred_pruning': False,
     'post_sample_size': 1.0,
+    # Store the hangs RDD as batches of interned integer columns rather than one
+    # tuple per hang, which is much cheaper to pickle between stages.
+    'columnar_hangs': False,
+    'columnar_hang_block_size': 10000,
+    # pyspark.StorageLevel name for RDDs used by more than one stage, or None to
+    # recompute them every time.
+    'intermediate_storage_level': 'MEMORY_AND_DISK',
+    # Broadcast the symbol map and symbolicate stacks on the executors, before
+    # grouping, rather than on the driver after collecting them.
+    'symbolicate_on_executors': False,
+    # Build the per-thread profile tables in Spark, partitioned by thread, rather
+    # than collecting every grouped stack to the driver.
+    'distributed_profile_processing': False,
+    'profile_thread_partitions': 64,
+    # Serialize output files column by column straight into the gzip stream,
+    # instead of building the whole JSON document in memory first.
+    'streaming_json_output': False,
+    # With use_s3, upload output files as they're written, as a multipart upload.
+    # Implies streaming_json_output.
+    'stream_s3_upload': False,
+    's3_upload_part_size': 64 * 1024 * 1024,
+    # Any of 'json' (gzipped) and 'binary' (see serialization.write_binary_profile).
+    # read_file reads binary files if they're being written.
+    'output_formats': ['json'],
+    # Store integer columns in binary files as differences between consecutive values.
+    'binary_delta_encoding': True,
+    # Number of days etl_job_incremental_write processes at once.
+    'incremental_write_concurrency': 1,
+    # Parse incremental files one thread at a time while finalizing, rather than
+    # loading each day's file whole.
+    'lazy_incremental_reads': False,
+    # Where etl_job saves its progress, as a local path or s3://bucket/key. None
+    # disables checkpoints. Not used with distributed_profile_processing.
+    'checkpoint_path': None,
+    # Write a checkpoint after every this many days.
+    'checkpoint_interval': 1,
+    # Load the checkpoint at checkpoint_path, if there is one, and skip the days
+    # it already covers. Fails if it was written with a different window or
+    # settings (see checkpoint.CHECKPOINT_JOB_KEYS). The checkpoint is deleted
+    # once the output is written.
+    'resume_from_checkpoint': False,
+    # Whether etl_job_rolling deletes local incremental files for days that have
+    # left the window.
+    'rolling_window_evict': True,
+    # etl_job_rolling recomputes this many of the window's most recent days even
+    # if they were already written. Older days are never recomputed, so pings
+    # submitted after a day was written are missed unless it's within this many
+    # days of the end of the window.
+    'rolling_window_refresh_days': 0,
+    # Read pings from the bhr docType partitions, decoding only the properties we
+    # use, when the telemetry dataset has them. Falls back to filtering OTHER pings.
+    'pushdown_ping_loading': False,
+    # Have get_data return raw pings, and validate them and extract their hangs
+    # and usage hours in a single pass, without get_pings_properties. Ignored
+    # with TMP_use_crashes.
+    'fused_ping_decoding': False,
+    # Sum usage hours in the same pass over the pings that extracts their hangs,
+    # instead of in a separate job over the valid pings.
+    'single_pass_usage_hours': False,
     'TMP_use_crashes': False,
     'exclude_modules': False,
     'uuid': uuid.uuid4().hex,
 }
 
+# The settings that change an incremental file's aggregates. etl_job_rolling
+# only reuses files that were written with the same ones.
+INCREMENTAL_JOB_KEYS = CHECKPOINT_JOB_KEYS + ['use_minimal_sample_table', 'exclude_modules',
+                                              'TMP_use_crashes']
+
 def print_progress(job_start, iterations, current_iteration,
                    iteration_start, iteration_name):
     iteration_end = time.time()
@@ -506,6 +740,23 @@ def print_progress(job_start, iterations, current_iteration,
     remaining = projected - job_elapsed
     print "Job should finish in {}".format(timedelta(seconds=remaining))
 
+def resume_from_checkpoint(profile_processor, checkpoint_path, checkpoint_job):
+    # Returns the dates the checkpoint had already ingested, if there is one.
+    checkpoint = time_code("Loading checkpoint",
+                           lambda: load_checkpoint(checkpoint_path, checkpoint_job))
+    if checkpoint is None:
+        return set()
+    profile_processor.set_state(checkpoint['processor'])
+    print "Resuming with {} days already ingested".format(len(checkpoint['completedDates']))
+    return checkpoint['completedDates']
+
+def checkpoint_if_due(profile_processor, checkpoint_path, checkpoint_job, completed_dates,
+                      interval):
+    if len(completed_dates) % interval == 0:
+        time_code("Writing checkpoint",
+                  lambda: save_checkpoint(checkpoint_path, checkpoint_job, completed_dates,
+                                          profile_processor.get_state()))
+
 def etl_job(sc, _, config=None):
     """This is the function that will be executed on the cluster"""
 
@@ -519,31 +770,70 @@ def etl_job(sc, _, config=None):
         final_config['hang_profile_out_filename'] = final_config['hang_profile_in_filename']
 
     profile_processor = ProfileProcessor(final_config)
+    distributed = final_config['distributed_profile_processing']
+    distributed_rows = []
+    distributed_usage_hours = {}
+
+    # Checkpoints hold the processor's tables, so they're only written when
+    # the processor does the ingesting.
+    checkpoint_path = None if distributed else final_config['checkpoint_path']
+    checkpoint_job = get_checkpoint_job(final_config, profile_processor)
+    completed_dates = set()
+    if checkpoint_path is not None and final_config['resume_from_checkpoint']:
+        completed_dates = resume_from_checkpoint(profile_processor, checkpoint_path,
+                                                 checkpoint_job)
 
     iterations = (final_config['end_date'] - final_config['start_date']).days
     job_start = time.time()
     current_date = None
     transformed = None
     usage_hours = None
+    known_symbols = KnownSymbols(final_config['known_symbols_max_entries'])
     # We were OOMing trying to allocate a contiguous array for all of this. Pass it in
     # bit by bit to the profile processor and hope it can handle it.
     for x in xrange(0, iterations):
         iteration_start = time.time()
         current_date = final_config['start_date'] + timedelta(days=x)
+        date_str = current_date.strftime("%Y%m%d")
+        if date_str in completed_dates:
+            print "Skipping {}, which was already ingested".format(date_str)
+            continue
         data = time_code("Getting data",
                          lambda: get_data(sc, final_config, current_date))
         if data is None:
             continue
-        transformed, usage_hours = transform_pings(sc, data, final_config)
-        time_code("Passing stacks to processor", lambda: profile_processor.ingest(transformed, usage_hours))
+        if distributed:
+            # Keep each day's grouped stacks on the cluster, and build the
+            # profile from all of them at the end.
+            rows, usage_hours = transform_pings_distributed(sc, data, final_config,
+                                                            known_symbols)
+            distributed_rows.append(rows)
+            distributed_usage_hours = merge_number_dicts(distributed_usage_hours, usage_hours)
+        else:
+            transformed, usage_hours = transform_pings(sc, data, final_config, known_symbols)
+            time_code("Passing stacks to processor", lambda: profile_processor.ingest(transformed, usage_hours))
+            if checkpoint_path is not None:
+                completed_dates.add(date_str)
+                checkpoint_if_due(profile_processor, checkpoint_path, checkpoint_job,
+                                  completed_dates, final_config['checkpoint_interval'])
         # Run a collection to ensure that any references to any RDDs are cleaned up,
         # allowing the JVM to clean them up on its end.
         gc.collect()
         print_progress(job_start, iterations, x, iteration_start, x)
 
-    profile = profile_processor.process_into_profile()
+    if distributed_rows:
+        profile = time_code("Processing profile",
+                            lambda: process_profile_distributed(distributed_rows,
+                                                                distributed_usage_hours,
+                                                                final_config))
+    else:
+        profile = profile_processor.process_into_profile()
     write_file(final_config['hang_profile_out_filename'], profile, final_config)
 
+    # The output is written, so a later run must not resume from this one.
+    if checkpoint_path is not None:
+        delete_checkpoint(checkpoint_path)
+
 def etl_job_tracked_stats(sc, _, config=None):
     final_config = {}
     final_config.update(default_config)
@@ -556,7 +846,7 @@ def etl_job_tracked_stats(sc, _, config=None):
     data = time_code("Getting data",
                      lambda: get_data(sc, final_config,
                                       final_config['start_date'], final_config['end_date']))
-    histograms = count_hangs_in_pings(sc, data, get_tracked_stats())
+    histograms = count_hangs_in_pings(sc, data, get_tracked_stats(), final_config)
     write_file(final_config['hang_profile_out_filename'], histograms, final_config)
 
 def etl_job_incremental_write(sc, _, config=None):
@@ -570,26 +860,56 @@ def etl_job_incremental_write(sc, _, config=None):
         final_config['hang_profile_out_filename'] = final_config['hang_profile_in_filename']
 
     iterations = (final_config['end_date'] - final_config['start_date']).days
+    dates = [final_config['start_date'] + timedelta(days=x) for x in xrange(iterations)]
     job_start = time.time()
-    current_date = None
-    transformed = None
-    usage_hours = None
-    for x in xrange(iterations):
-        iteration_start = time.time()
-        current_date = final_config['start_date'] + timedelta(days=x)
-        date_str = current_date.strftime("%Y%m%d")
-        data = time_code("Getting data",
-                         lambda: get_data(sc, final_config, current_date))
-        if data is None:
-            continue
-        transformed, usage_hours = transform_pings(sc, data, final_config)
-        profile_processor = ProfileProcessor(final_config)
-        profile_processor.ingest(transformed, usage_hours)
-        profile = profile_processor.process_into_profile()
-        write_file("%s_incremental_%s" % (final_config['hang_profile_out_filename'], date_str),
-                   profile, final_config)
+    known_symbols = KnownSymbols(final_config['known_symbols_max_entries'])
+
+    concurrency = final_config['incremental_write_concurrency']
+    if concurrency <= 1:
+        for x, current_date in enumerate(dates):
+            iteration_start = time.time()
+            write_incremental_day(sc, final_config, current_date, known_symbols=known_symbols)
+            print_progress(job_start, iterations, x, iteration_start,
+                           current_date.strftime("%Y%m%d"))
+        return
+
+    # Spark runs jobs submitted from different driver threads concurrently, so
+    # one day's executor work can overlap another's driver-side ingest. Days
+    # share the symbols already processed on the driver, and the executors'
+    # symbol caches (see symbol_cache_dir).
+    pool = ThreadPool(concurrency)
+    try:
+        days = pool.imap_unordered(lambda d: write_incremental_day(sc, final_config, d,
+                                                                   time.time(), known_symbols),
+                                   dates)
+        for x, (current_date, iteration_start) in enumerate(days):
+            print_progress(job_start, iterations, x, iteration_start,
+                           current_date.strftime("%Y%m%d"))
+    finally:
+        pool.close()
+        pool.join()
+
+def write_incremental_day(sc, config, current_date, iteration_start=None, known_symbols=None):
+    date_str = current_date.strftime("%Y%m%d")
+    data = time_code("Getting data for " + date_str,
+                     lambda: get_data(sc, config, current_date))
+    if data is not None:
+        if config['distributed_profile_processing']:
+            rows, usage_hours = transform_pings_distributed(sc, data, config, known_symbols)
+            try:
+                profile = process_profile_distributed([rows], usage_hours, config)
+            finally:
+                unpersist_rdds(rows)
+        else:
+            transformed, usage_hours = transform_pings(sc, data, config, known_symbols)
+            profile_processor = ProfileProcessor(config)
+            profile_processor.ingest(transformed, usage_hours)
+            profile = profile_processor.process_into_profile()
+        name = "%s_incremental_%s" % (config['hang_profile_out_filename'], date_str)
+        write_file(name, profile, config)
+        write_job_file(name, {k: config[k] for k in INCREMENTAL_JOB_KEYS}, config)
         gc.collect()
-        print_progress(job_start, iterations, x, iteration_start, date_str)
+    return current_date, iteration_start
 
 def etl_job_incremental_finalize(_, __, config=None):
     final_config = {}
@@ -609,9 +929,12 @@ def etl_job_incremental_finalize(_, __, config=None):
         iteration_start = time.time()
         current_date = final_config['start_date'] + timedelta(days=x)
         date_str = current_date.strftime("%Y%m%d")
-        profile = read_file("%s_incremental_%s" % (final_config['hang_profile_in_filename'], date_str),
-                            final_config)
-        profile_processor.ingest_processed_profile(profile)
+        name = "%s_incremental_%s" % (final_config['hang_profile_in_filename'], date_str)
+        if final_config['lazy_incremental_reads']:
+            ingest_file_lazily(profile_processor, name, final_config)
+        else:
+            profile = read_file(name, final_config)
+            profile_processor.ingest_processed_profile(profile)
         gc.collect()
         print_progress(job_start, iterations, x, iteration_start, date_str)
 
@@ -624,3 +947,49 @@ def etl_job_incremental_finalize(_, __, config=None):
     else:
         profile = profile_processor.process_into_profile()
         write_file(final_config['hang_profile_out_filename'], profile, final_config)
+
+def etl_job_rolling(sc, _, config=None):
+    """Like etl_job, but only computes the days of the window that previous runs
+    haven't already written incremental files for (and the last
+    rolling_window_refresh_days), then builds the profile from those files. Files
+    written with different settings (see INCREMENTAL_JOB_KEYS) are recomputed."""
+    final_config = {}
+    final_config.update(default_config)
+
+    if config is not None:
+        final_config.update(config)
+
+    if final_config['hang_profile_out_filename'] is None:
+        final_config['hang_profile_out_filename'] = final_config['hang_profile_in_filename']
+    out_filename = final_config['hang_profile_out_filename']
+    if final_config['append_date']:
+        raise Exception("etl_job_rolling can't find earlier runs' files with append_date set")
+
+    job = {k: final_config[k] for k in INCREMENTAL_JOB_KEYS}
+    iterations = (final_config['end_date'] - final_config['start_date']).days
+    refresh_from = iterations - final_config['rolling_window_refresh_days']
+    pending_dates = []
+    for x in xrange(iterations):
+        current_date = final_config['start_date'] + timedelta(days=x)
+        date_str = current_date.strftime("%Y%m%d")
+        name = "%s_incremental_%s" % (out_filename, date_str)
+        if (x < refresh_from and file_exists(name, final_config) and
+                read_job_file(name, final_config) == job):
+            print "Reusing the aggregates for {}".format(date_str)
+        else:
+            pending_dates.append(current_date)
+
+    job_start = time.time()
+    known_symbols = KnownSymbols(final_config['known_symbols_max_entries'])
+    for x, current_date in enumerate(pending_dates):
+        iteration_start = time.time()
+        write_incremental_day(sc, final_config, current_date, known_symbols=known_symbols)
+        print_progress(job_start, len(pending_dates), x, iteration_start,
+                       current_date.strftime("%Y%m%d"))
+
+    if final_config['rolling_window_evict']:
+        evict_incremental_files(out_filename, final_config['start_date'])
+
+    finalize_config = dict(final_config)
+    finalize_config['hang_profile_in_filename'] = out_filename
+    etl_job_incremental_finalize(sc, None, finalize_config)
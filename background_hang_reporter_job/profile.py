@@ -1,5 +1,6 @@
 import random
 import re
+from array import array
 from sets import Set
 
 # For now we want like deterministic results, to aid debugging
@@ -76,6 +77,8 @@ def to_struct_of_arrays(a):
     return result
 
 class UniqueKeyedTable(object):
+    __slots__ = ('get_default_from_key', 'key_to_index_map', 'key_names', 'items')
+
     def __init__(self, get_default_from_key, key_names=()):
         self.get_default_from_key = get_default_from_key
         self.key_to_index_map = {}
@@ -118,17 +121,145 @@ class UniqueKeyedTable(object):
     def sorted_struct_of_arrays(self, key):
         return self.inner_struct_of_arrays(sorted(self.items, key=key))
 
-class GrowToFitList(list):
-    def __setitem__(self, index, value):
-        if index >= len(self):
-            to_grow = index + 1 - len(self)
-            self.extend([None] * to_grow)
-        list.__setitem__(self, index, value)
+    def get_state(self):
+        # get_default_from_key is left out, since it's usually a closure over
+        # other tables and can't be pickled.
+        return self.key_to_index_map, self.items
+
+    def set_state(self, state):
+        self.key_to_index_map, self.items = state
+
+NULL_INDEX = -1
+
+class TypedArray(array):
+    # An array subclass with a fixed typecode, so it can be created without
+    # one. Unpickling passes the typecode back in.
+    default_typecode = 'i'
+
+    def __new__(cls, *args):
+        return array.__new__(cls, *(args or (cls.default_typecode,)))
+
+class IndexArray(TypedArray):
+    # An array('i') of table indices where None is stored as NULL_INDEX.
+    def append(self, value):
+        array.append(self, NULL_INDEX if value is None else value)
+
+    def __getitem__(self, index):
+        value = array.__getitem__(self, index)
+        return None if value == NULL_INDEX else value
+
+    def tolist(self):
+        return [None if x == NULL_INDEX else x for x in array.tolist(self)]
+
+class BoolArray(TypedArray):
+    default_typecode = 'b'
 
     def __getitem__(self, index):
-        if index >= len(self):
+        return bool(array.__getitem__(self, index))
+
+    def tolist(self):
+        return [bool(x) for x in array.tolist(self)]
+
+class TypedUniqueKeyedTable(UniqueKeyedTable):
+    """A UniqueKeyedTable whose items are tuples of integers or booleans.
+
+    Each position of the item tuples is stored in its own typed array as rows
+    are added, so struct_of_arrays can return the columns themselves rather
+    than copying them out of a list of tuples. column_types holds the array
+    class for each position of the items.
+    """
+    __slots__ = ('columns', 'length')
+
+    def __init__(self, get_default_from_key, key_names, column_types):
+        super(TypedUniqueKeyedTable, self).__init__(get_default_from_key, key_names)
+        self.columns = [column_type() for column_type in column_types]
+        self.length = 0
+
+    def key_to_index(self, key):
+        index = self.key_to_index_map.get(key)
+        if index is not None:
+            return index
+
+        index = self.length
+        for column, value in zip(self.columns, self.get_default_from_key(key)):
+            column.append(value)
+        self.length += 1
+        self.key_to_index_map[key] = index
+        return index
+
+    def key_to_item(self, key):
+        return self.index_to_item(self.key_to_index(key))
+
+    def index_to_item(self, index):
+        return tuple(column[index] for column in self.columns)
+
+    def get_items(self):
+        return [self.index_to_item(i) for i in xrange(self.length)]
+
+    def struct_of_arrays(self):
+        if self.length == 0:
+            raise Exception('Need at least one item in array for this to work.')
+
+        result = {}
+        for i, key_name in enumerate(self.key_names):
+            result[key_name] = self.columns[i]
+
+        result['length'] = self.length
+        return result
+
+    def sorted_struct_of_arrays(self, key):
+        return self.inner_struct_of_arrays(sorted(self.get_items(), key=key))
+
+    def get_state(self):
+        return self.key_to_index_map, self.columns, self.length
+
+    def set_state(self, state):
+        self.key_to_index_map, self.columns, self.length = state
+
+def int_array():
+    return array('i')
+
+def to_json_compatible(obj):
+    # Typed tables and date columns hand out arrays, which the JSON encoder can't handle.
+    if isinstance(obj, (array, FloatColumn)):
+        return obj.tolist()
+    if isinstance(obj, dict):
+        return {k: to_json_compatible(v) for k, v in obj.iteritems()}
+    if isinstance(obj, (list, tuple)) and obj and isinstance(obj[0], (dict, list, tuple, array,
+                                                                      FloatColumn)):
+        return [to_json_compatible(v) for v in obj]
+    return obj
+
+class FloatColumn(object):
+    # A growable array of doubles, indexed by sample. Samples that were never
+    # added to read as 0.0 and are written out as None, since a sample that
+    # occurred always has a positive count and duration.
+    __slots__ = ('values', 'length')
+
+    def __init__(self):
+        self.values = array('d')
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index >= self.length:
             return None
-        return list.__getitem__(self, index)
+        return self.values[index]
+
+    def add(self, index, value):
+        capacity = len(self.values)
+        if index >= capacity:
+            # Grow geometrically so that appending samples is amortized O(1).
+            new_capacity = max(index + 1, capacity * 2, 16)
+            self.values.extend(array('d', [0.0]) * (new_capacity - capacity))
+        self.values[index] += value
+        if index >= self.length:
+            self.length = index + 1
+
+    def tolist(self):
+        return [x if x else None for x in self.values[:self.length]]
 
 def hexify(num):
     return "{0:#0{1}x}".format(num, 8)
@@ -143,31 +274,37 @@ def get_default_lib(name):
         'arch': "",
     })
 
-def get_default_thread(name, minimal_sample_table):
+def get_default_thread(name, minimal_sample_table, typed_tables=False):
+    def make_table(get_default_from_key, key_names, column_types):
+        if typed_tables:
+            return TypedUniqueKeyedTable(get_default_from_key, key_names, column_types)
+        return UniqueKeyedTable(get_default_from_key, key_names)
+
     strings_table = UniqueKeyedTable(lambda str: str)
     libs = UniqueKeyedTable(get_default_lib)
-    func_table = UniqueKeyedTable(lambda key: (
+    func_table = make_table(lambda key: (
         strings_table.key_to_index(key[0]),
         None if key[1] is None else libs.key_to_index(key[1])
-    ), ('name', 'lib'))
-    stack_table = UniqueKeyedTable(lambda key: (
+    ), ('name', 'lib'), (int_array, IndexArray))
+    stack_table = make_table(lambda key: (
         key[2],
         func_table.key_to_index((key[0], key[1]))
-    ), ('prefix', 'func'))
+    ), ('prefix', 'func'), (IndexArray, int_array))
+    sample_columns = (int_array, int_array, BoolArray, int_array)
     if minimal_sample_table:
-        sample_table = UniqueKeyedTable(lambda key: (
+        sample_table = make_table(lambda key: (
             key[0],
             strings_table.key_to_index(key[1]),
             key[2],
             strings_table.key_to_index(key[3]),
-        ), ('stack', 'platform'))
+        ), ('stack', 'platform'), sample_columns)
     else:
-        sample_table = UniqueKeyedTable(lambda key: (
+        sample_table = make_table(lambda key: (
             key[0],
             strings_table.key_to_index(key[1]),
             key[2],
             strings_table.key_to_index(key[3]),
-        ), ('stack', 'runnable', 'userInteracting', 'platform'))
+        ), ('stack', 'runnable', 'userInteracting', 'platform'), sample_columns)
 
     stack_table.key_to_index(('(root)', None, None))
 
@@ -183,50 +320,128 @@ def get_default_thread(name, minimal_sample_table):
         'sampleTable': sample_table,
         'stringArray': strings_table,
         'processType': 'tab' if name == 'Gecko_Child' or name == 'Gecko_Child_ForcePaint' else 'default',
-        'dates': UniqueKeyedTable(lambda date: ({
-            'date': date,
-            'sampleHangMs': GrowToFitList(),
-            'sampleHangCount': GrowToFitList()
-        }), ('date', 'sampleHangMs', 'sampleHangCount')),
+        'dates': get_default_dates_table(),
     }
 
-def sample_categorizer(categories, stack_table, func_table, string_array):
-    func_name_to_category_cache = {}
-
-    def function_name_to_category(name):
-        if name in func_name_to_category_cache:
-            return func_name_to_category_cache[name]
-
-        for matches, pattern, category in categories:
-            if matches(name, pattern):
-                func_name_to_category_cache[name] = category
-                return category
-
-        func_name_to_category_cache[name] = False
-        return False
-
-    stack_category_cache = {}
-
-    def compute_category(stack_index):
-        while True:
-            if stack_index in stack_category_cache:
-                return stack_category_cache[stack_index]
+def get_default_dates_table():
+    return UniqueKeyedTable(lambda date: ({
+        'date': date,
+        'sampleHangMs': FloatColumn(),
+        'sampleHangCount': FloatColumn()
+    }), ('date', 'sampleHangMs', 'sampleHangCount'))
+
+def get_keys_by_index(table):
+    keys = [None] * len(table.key_to_index_map)
+    for key, index in table.key_to_index_map.iteritems():
+        keys[index] = key
+    return keys
+
+class CategoryMatcher(object):
+    """Maps function names to the category of the first rule in `categories`
+    they match.
+
+    Exact, prefix and stem rules are compiled into a dict and a prefix trie, so a
+    name is checked against all of them in a single walk. Substring rules are
+    prefiltered with one combined regex. Results are cached by name.
+    """
+    def __init__(self, categories):
+        self.categories = [category for _, _, category in categories]
+        self.exact = {}
+        # Each trie node is [children by character, lowest rule index ending here].
+        self.trie = [{}, None]
+        self.substrings = []
+        self.other = []
+        for rule_index, (matches, pattern, _) in enumerate(categories):
+            if matches is match_exact:
+                self.add_exact(pattern, rule_index)
+            elif matches is match_prefix:
+                self.add_prefix(pattern, rule_index)
+            elif matches is match_stem:
+                self.add_exact(pattern, rule_index)
+                self.add_prefix(pattern + '(', rule_index)
+            elif matches is match_substring:
+                self.substrings.append((rule_index, pattern))
             else:
-                if not stack_index:
-                    stack_category_cache[stack_index] = None
-                    return None
-                else:
-                    func_index = stack_table['func'][stack_index]
-                    name = string_array.index_to_item(func_table['name'][func_index])
-                    category = function_name_to_category(name)
-
-                if category != False:
-                    stack_category_cache[stack_index] = category
-                    return category
-
-                stack_index = stack_table['prefix'][stack_index]
+                self.other.append((rule_index, matches, pattern))
+        if self.substrings:
+            self.substring_regex = re.compile('|'.join(re.escape(p) for _, p in self.substrings))
+        else:
+            self.substring_regex = None
+        self.cache = {}
+
+    def add_exact(self, pattern, rule_index):
+        if pattern not in self.exact:
+            self.exact[pattern] = rule_index
+
+    def add_prefix(self, pattern, rule_index):
+        node = self.trie
+        for c in pattern:
+            node = node[0].setdefault(c, [{}, None])
+        if node[1] is None:
+            node[1] = rule_index
+
+    def first_matching_rule(self, name):
+        best = self.exact.get(name)
+
+        node = self.trie
+        for c in name:
+            node = node[0].get(c)
+            if node is None:
+                break
+            if node[1] is not None and (best is None or node[1] < best):
+                best = node[1]
+
+        if self.substring_regex is not None and self.substring_regex.search(name):
+            for rule_index, pattern in self.substrings:
+                if best is not None and rule_index > best:
+                    break
+                if pattern in name:
+                    best = rule_index
+                    break
+
+        for rule_index, matches, pattern in self.other:
+            if best is not None and rule_index > best:
+                break
+            if matches(name, pattern):
+                best = rule_index
+                break
 
-    return compute_category
+        return best
+
+    def categorize(self, name):
+        category = self.cache.get(name)
+        if category is None:
+            rule_index = self.first_matching_rule(name)
+            category = False if rule_index is None else self.categories[rule_index]
+            self.cache[name] = category
+        return category
+
+_category_matchers = {}
+
+# Matchers (and their name caches) are shared by every thread and every profile
+# processed in this process.
+def get_category_matcher(categories):
+    key = tuple(categories)
+    if key not in _category_matchers:
+        _category_matchers[key] = CategoryMatcher(categories)
+    return _category_matchers[key]
+
+def categorize_stacks(categories, stack_table, func_table, string_array):
+    # A stack's category is that of its innermost categorized frame. Prefixes
+    # always come before the stacks using them, so one pass from the root down
+    # fills in every stack.
+    matcher = get_category_matcher(categories)
+    func_categories = [matcher.categorize(string_array.index_to_item(name))
+                       for name in func_table['name']]
+    funcs = stack_table['func']
+    prefixes = stack_table['prefix']
+    stack_categories = [None] * len(funcs)
+    for stack_index in xrange(1, len(funcs)):
+        category = func_categories[funcs[stack_index]]
+        if category is False:
+            category = stack_categories[prefixes[stack_index]]
+        stack_categories[stack_index] = category
+    return stack_categories
 
 def reconstruct_stack(string_array, func_table, stack_table, lib_table, stack_index):
     result = []
@@ -243,68 +458,303 @@ def merge_number_dicts(a, b):
     keys = Set(a.keys() + b.keys())
     return {k: a.get(k, 0.) + b.get(k, 0.) for k in keys}
 
+def add_processed_stacks_to_prune_cache(thread, other):
+    # Returns a processed thread's stack table, with each stack's function
+    # name and library, its weight and its node in our prune cache.
+    string_array = other['stringArray']
+    prefixes = other['stackTable']['prefix']
+    funcs = other['stackTable']['func']
+    sample_stacks = other['sampleTable']['stack']
+    num_stacks = len(prefixes)
+    stacks = {
+        'prefix': prefixes,
+        'func': funcs,
+        'funcName': [string_array[name] for name in other['funcTable']['name']],
+        'funcLib': [None if lib is None else other['libs'][lib]['debugName']
+                    for lib in other['funcTable']['lib']],
+    }
+
+    # Total hang ms under each of the other thread's stacks, which is what the
+    # prune cache would get from ingesting each sample's stack in turn.
+    weights = [0.0] * num_stacks
+    for date in other['dates']:
+        for i, hang_ms in enumerate(date['sampleHangMs']):
+            if hang_ms:
+                weights[sample_stacks[i]] += hang_ms
+    for stack_index in xrange(num_stacks - 1, 0, -1):
+        weights[prefixes[stack_index]] += weights[stack_index]
+
+    prune_stack_cache = thread['pruneStackCache']
+    prune_stack_cache.index_to_item(0)[0] += weights[0]
+    cache_indices = [0] * num_stacks
+    for stack_index in xrange(1, num_stacks):
+        if not weights[stack_index]:
+            continue
+        func_index = funcs[stack_index]
+        cache_item_index = prune_stack_cache.key_to_index((stacks['funcName'][func_index],
+                                                           stacks['funcLib'][func_index],
+                                                           cache_indices[prefixes[stack_index]]))
+        prune_stack_cache.index_to_item(cache_item_index)[0] += weights[stack_index]
+        cache_indices[stack_index] = cache_item_index
+
+    stacks['weight'] = weights
+    stacks['cacheIndex'] = cache_indices
+    return stacks
+
+def prune_processed_stacks(thread, stacks, threshold):
+    # Maps each of a processed thread's stacks to a stack in ours, applying the
+    # acceptance threshold the same way ingest_row does.
+    prefixes = stacks['prefix']
+    funcs = stacks['func']
+    weights = stacks['weight']
+    cache_indices = stacks['cacheIndex']
+    stack_table = thread['stackTable']
+    prune_stack_cache = thread['pruneStackCache']
+    pruned_stacks = [0] * len(prefixes)
+    is_pruned = [False] * len(prefixes)
+    for stack_index in xrange(1, len(prefixes)):
+        if not weights[stack_index]:
+            continue
+        prefix = prefixes[stack_index]
+        if is_pruned[prefix]:
+            pruned_stacks[stack_index] = pruned_stacks[prefix]
+            is_pruned[stack_index] = True
+            continue
+
+        func_index = funcs[stack_index]
+        lib_name = stacks['funcLib'][func_index]
+        cache_item = prune_stack_cache.index_to_item(cache_indices[stack_index])
+        parent_cache_item = prune_stack_cache.index_to_item(cache_indices[prefix])
+        if cache_item[0] / parent_cache_item[0] > threshold:
+            pruned_stacks[stack_index] = stack_table.key_to_index(
+                (stacks['funcName'][func_index], lib_name, pruned_stacks[prefix]))
+        else:
+            # If we're below the acceptance threshold, just lump it under (other) below
+            # its parent.
+            pruned_stacks[stack_index] = stack_table.key_to_index(
+                ('(other)', lib_name, pruned_stacks[prefix]))
+            is_pruned[stack_index] = True
+    return pruned_stacks
+
 class ProfileProcessor(object):
     def __init__(self, config):
         self.config = config
+        self.deferred_pruning = config['deferred_pruning']
         def default_thread_closure(name):
-            return get_default_thread(name, config['use_minimal_sample_table'])
+            thread = get_default_thread(name, config['use_minimal_sample_table'],
+                                        config['use_typed_tables'])
+            if self.deferred_pruning:
+                # Unpruned samples, keyed by the prune cache node of their leaf frame
+                # and with per-date values indexed like the sample table's.
+                thread['pendingSampleTable'] = UniqueKeyedTable(lambda key: None)
+                thread['pendingDates'] = get_default_dates_table()
+            return thread
         self.thread_table = UniqueKeyedTable(default_thread_closure)
         self.usage_hours_by_date = {}
 
+    def get_state(self):
+        # Everything ingested so far, in a picklable form for set_state.
+        threads = []
+        for thread in self.thread_table.get_items():
+            threads.append({
+                k: v.get_state() if isinstance(v, UniqueKeyedTable) else v
+                for k, v in thread.iteritems()
+            })
+        return {
+            'tableLayout': self.get_table_layout(),
+            'threads': threads,
+            'usageHoursByDate': self.usage_hours_by_date,
+        }
+
+    def set_state(self, state):
+        if state['tableLayout'] != self.get_table_layout():
+            raise Exception('Processor state was saved with different table settings: {}'.format(
+                state['tableLayout']))
+
+        self.thread_table = UniqueKeyedTable(self.thread_table.get_default_from_key)
+        for thread_state in state['threads']:
+            thread = self.thread_table.key_to_item(thread_state['name'])
+            for k, v in thread_state.iteritems():
+                if isinstance(thread.get(k), UniqueKeyedTable):
+                    thread[k].set_state(v)
+                else:
+                    thread[k] = v
+        self.usage_hours_by_date = state['usageHoursByDate']
+
+    def get_table_layout(self):
+        return {
+            k: self.config[k]
+            for k in ('use_minimal_sample_table', 'use_typed_tables', 'deferred_pruning')
+        }
+
     def debugDump(self, dump_str):
         if self.config['print_debug_info']:
             print dump_str
 
     def ingest_processed_profile(self, profile):
-        for existing_thread in self.thread_table.get_items():
-            prune_stack_cache = UniqueKeyedTable(lambda key: [0.0])
-            prune_stack_cache.key_to_index(('(root)', None, None))
-            existing_thread['pruneStackCache'] = prune_stack_cache
+        self.ingest_processed_threads(profile['threads'])
+        self.ingest_usage_hours(profile.get('usageHoursByDate', {}))
+
+    def ingest_usage_hours(self, usage_hours_by_date):
+        self.usage_hours_by_date = merge_number_dicts(self.usage_hours_by_date, usage_hours_by_date)
+
+    def ingest_processed_threads(self, threads):
+        # threads may be any iterable, such as LazyJSONProfile.iter_threads().
+        if not self.deferred_pruning:
+            # Each incoming profile is pruned against its own weights.
+            for existing_thread in self.thread_table.get_items():
+                prune_stack_cache = UniqueKeyedTable(lambda key: [0.0])
+                prune_stack_cache.key_to_index(('(root)', None, None))
+                existing_thread['pruneStackCache'] = prune_stack_cache
 
-        sample_size = self.config['post_sample_size']
-        threads = profile['threads']
         for other in threads:
-            other_samples = other['sampleTable']
-            other_dates = other['dates']
-
-            for date in other_dates:
-                build_date = date['date']
-                for i in xrange(0, len(date['sampleHangCount'])):
-                    stack_index = other_samples['stack'][i]
-                    stack = reconstruct_stack(other['stringArray'],
-                                              other['funcTable'],
-                                              other['stackTable'],
-                                              other['libs'],
-                                              stack_index)
-                    self.pre_ingest_row((stack,
-                                         other['stringArray'][other_samples['runnable'][i]],
-                                         other['name'],
-                                         build_date,
-                                         other_samples['userInteracting'][i],
-                                         other['stringArray'][other_samples['platform'][i]],
-                                         date['sampleHangMs'][i],
-                                         date['sampleHangCount'][i]))
-
-            for date in other_dates:
-                build_date = date['date']
-                for i in xrange(0, len(date['sampleHangCount'])):
-                    stack_index = other_samples['stack'][i]
-                    stack = reconstruct_stack(other['stringArray'],
-                                              other['funcTable'],
-                                              other['stackTable'],
-                                              other['libs'],
-                                              stack_index)
-                    if sample_size == 1.0 or random.random() <= sample_size:
-                        self.ingest_row((stack,
-                                         other['stringArray'][other_samples['runnable'][i]],
-                                         other['name'],
-                                         build_date,
-                                         other_samples['userInteracting'][i],
-                                         other['stringArray'][other_samples['platform'][i]],
-                                         date['sampleHangMs'][i],
-                                         date['sampleHangCount'][i]))
-
-        self.usage_hours_by_date = merge_number_dicts(self.usage_hours_by_date, profile.get('usageHoursByDate', {}))
+            self.ingest_processed_thread(other)
+
+    def ingest_processed_thread(self, other):
+        # Merges a thread from a processed profile by translating its tables into
+        # ours once per stack, rather than rebuilding every sample's stack. This
+        # relies on a stack's prefix always coming before it in the stack table,
+        # which is how UniqueKeyedTable builds it. The result is semantically
+        # equivalent to merging sample by sample, but rows may be added to our
+        # tables in a different order.
+        thread = self.thread_table.key_to_item(other['name'])
+        stacks = add_processed_stacks_to_prune_cache(thread, other)
+        if self.deferred_pruning:
+            # Samples are recorded against their leaf's prune cache node, and
+            # pruned in apply_deferred_pruning.
+            targets = (stacks['cacheIndex'], thread['pendingSampleTable'], thread['pendingDates'],
+                       False)
+        else:
+            targets = (prune_processed_stacks(thread, stacks,
+                                              self.config['stack_acceptance_threshold']),
+                       thread['sampleTable'],
+                       thread['dates'],
+                       self.config['use_minimal_sample_table'] and other['name'] == 'Gecko_Child')
+        self.ingest_processed_samples(other, targets)
+
+    def ingest_processed_samples(self, other, targets):
+        target_stacks, target_sample_table, target_dates, skip_non_interacting = targets
+        string_array = other['stringArray']
+        other_samples = other['sampleTable']
+        sample_stacks = other_samples['stack']
+        sample_size = self.config['post_sample_size']
+        sample_indices = {}
+        for date in other['dates']:
+            target_date = None
+            hang_ms_column = date['sampleHangMs']
+            for i, hang_count in enumerate(date['sampleHangCount']):
+                hang_ms = hang_ms_column[i]
+                if not hang_ms:
+                    continue
+                if sample_size != 1.0 and random.random() > sample_size:
+                    continue
+                pending_input = other_samples['userInteracting'][i]
+                if skip_non_interacting and not pending_input:
+                    continue
+
+                sample_index = sample_indices.get(i)
+                if sample_index is None:
+                    sample_index = target_sample_table.key_to_index((
+                        target_stacks[sample_stacks[i]],
+                        string_array[other_samples['runnable'][i]],
+                        pending_input,
+                        string_array[other_samples['platform'][i]]))
+                    sample_indices[i] = sample_index
+
+                if target_date is None:
+                    target_date = target_dates.key_to_item(date['date'])
+                target_date['sampleHangCount'].add(sample_index, hang_count)
+                target_date['sampleHangMs'].add(sample_index, hang_ms)
+
+    def ingest_row_deferred(self, row, record_sample=True):
+        #pylint: disable=unused-variable
+        stack, runnable_name, thread_name, build_date, pending_input, platform, hang_ms, hang_count = row
+
+        thread = self.thread_table.key_to_item(thread_name)
+        prune_stack_cache = thread['pruneStackCache']
+        prune_stack_cache.index_to_item(0)[0] += hang_ms
+
+        last_cache_item_index = 0
+        for (func_name, lib_name) in stack:
+            last_cache_item_index = prune_stack_cache.key_to_index((func_name, lib_name, last_cache_item_index))
+            prune_stack_cache.index_to_item(last_cache_item_index)[0] += hang_ms
+
+        if not record_sample:
+            return
+
+        pending_index = thread['pendingSampleTable'].key_to_index((last_cache_item_index,
+                                                                   runnable_name,
+                                                                   pending_input,
+                                                                   platform))
+        date = thread['pendingDates'].key_to_item(build_date)
+        date['sampleHangCount'].add(pending_index, hang_count)
+        date['sampleHangMs'].add(pending_index, hang_ms)
+
+    def apply_deferred_pruning(self, thread):
+        # Builds the thread's stack, sample and date tables from its complete
+        # prune cache, in one walk over the cache from the root down. Returns a
+        # new thread, so this can be called again after ingesting more data.
+        result = get_default_thread(thread['name'], self.config['use_minimal_sample_table'],
+                                    self.config['use_typed_tables'])
+        stack_table = result['stackTable']
+        sample_table = result['sampleTable']
+        threshold = self.config['stack_acceptance_threshold']
+
+        prune_stack_cache = thread['pruneStackCache']
+        cache_keys = get_keys_by_index(prune_stack_cache)
+        # Prefixes are always added to the cache before the frames under them, so
+        # a node's parent has always been handled by the time we get to it.
+        pruned_stacks = [0] * len(cache_keys)
+        is_pruned = [False] * len(cache_keys)
+        for cache_item_index in xrange(1, len(cache_keys)):
+            func_name, lib_name, parent_index = cache_keys[cache_item_index]
+            if is_pruned[parent_index]:
+                pruned_stacks[cache_item_index] = pruned_stacks[parent_index]
+                is_pruned[cache_item_index] = True
+                continue
+
+            cache_item = prune_stack_cache.index_to_item(cache_item_index)
+            parent_cache_item = prune_stack_cache.index_to_item(parent_index)
+            if cache_item[0] / parent_cache_item[0] > threshold:
+                pruned_stacks[cache_item_index] = stack_table.key_to_index(
+                    (func_name, lib_name, pruned_stacks[parent_index]))
+            else:
+                # If we're below the acceptance threshold, just lump it under (other) below
+                # its parent.
+                pruned_stacks[cache_item_index] = stack_table.key_to_index(
+                    ('(other)', lib_name, pruned_stacks[parent_index]))
+                is_pruned[cache_item_index] = True
+
+        skip_non_interacting = (self.config['use_minimal_sample_table'] and
+                                thread['name'] == 'Gecko_Child')
+        sample_indices = []
+        for leaf_index, runnable_name, pending_input, platform in get_keys_by_index(
+                thread['pendingSampleTable']):
+            if skip_non_interacting and not pending_input:
+                sample_indices.append(None)
+            else:
+                sample_indices.append(sample_table.key_to_index(
+                    (pruned_stacks[leaf_index], runnable_name, pending_input, platform)))
+
+        for pending_date in thread['pendingDates'].get_items():
+            date = result['dates'].key_to_item(pending_date['date'])
+            pending_counts = pending_date['sampleHangCount']
+            pending_ms = pending_date['sampleHangMs']
+            for pending_index in xrange(len(pending_counts)):
+                sample_index = sample_indices[pending_index]
+                if sample_index is None or not pending_counts[pending_index]:
+                    continue
+                date['sampleHangCount'].add(sample_index, pending_counts[pending_index])
+                date['sampleHangMs'].add(sample_index, pending_ms[pending_index])
+
+        return result
+
+    def get_output_threads(self):
+        threads = self.thread_table.get_items()
+        if self.deferred_pruning:
+            print "Pruning stacks..."
+            return [self.apply_deferred_pruning(t) for t in threads]
+        return threads
 
     def pre_ingest_row(self, row):
         #pylint: disable=unused-variable
@@ -357,12 +807,8 @@ class ProfileProcessor(object):
         sample_index = sample_table.key_to_index((last_stack, runnable_name, pending_input, platform))
 
         date = dates.key_to_item(build_date)
-        if date['sampleHangCount'][sample_index] is None:
-            date['sampleHangCount'][sample_index] = 0.0
-            date['sampleHangMs'][sample_index] = 0.0
-
-        date['sampleHangCount'][sample_index] += hang_count
-        date['sampleHangMs'][sample_index] += hang_ms
+        date['sampleHangCount'].add(sample_index, hang_count)
+        date['sampleHangMs'].add(sample_index, hang_ms)
 
     def ingest(self, data, usage_hours_by_date):
         print "{} unfiltered samples in data".format(len(data))
@@ -374,13 +820,18 @@ class ProfileProcessor(object):
         ]
         print "{} filtered samples in data".format(len(data))
 
-        print "Preprocessing stacks for prune cache..."
-        for row in data:
-            self.pre_ingest_row(row)
+        if self.deferred_pruning:
+            print "Processing stacks..."
+            for row in data:
+                self.ingest_row_deferred(row)
+        else:
+            print "Preprocessing stacks for prune cache..."
+            for row in data:
+                self.pre_ingest_row(row)
 
-        print "Processing stacks..."
-        for row in data:
-            self.ingest_row(row)
+            print "Processing stacks..."
+            for row in data:
+                self.ingest_row(row)
 
         self.usage_hours_by_date = merge_number_dicts(self.usage_hours_by_date, usage_hours_by_date)
 
@@ -396,19 +847,17 @@ class ProfileProcessor(object):
         string_array = thread['stringArray']
         func_table = thread['funcTable'].struct_of_arrays()
         stack_table = thread['stackTable'].struct_of_arrays()
-        categorizer_p1 = sample_categorizer(categories_p1, stack_table, func_table, string_array)
-        categorizer_p2 = sample_categorizer(categories_p2, stack_table, func_table, string_array)
+        categories_by_p1 = categorize_stacks(categories_p1, stack_table, func_table, string_array)
+        categories_by_p2 = categorize_stacks(categories_p2, stack_table, func_table, string_array)
 
         sample_table = thread['sampleTable'].struct_of_arrays()
         sample_table['category'] = []
         for s in sample_table['stack']:
-            category_string = categorizer_p1(s)
+            category_string = categories_by_p1[s]
             if category_string is None:
-                category_string = categorizer_p2(s)
-                if category_string is None:
-                    sample_table['category'].append(None)
-                else:
-                    sample_table['category'].append(string_array.key_to_index(category_string))
+                category_string = categories_by_p2[s]
+            if category_string is None:
+                sample_table['category'].append(None)
             else:
                 sample_table['category'].append(string_array.key_to_index(category_string))
 
@@ -424,11 +873,12 @@ class ProfileProcessor(object):
         }
 
     def process_into_split_profile(self):
+        threads = self.get_output_threads()
         return {
             'main_payload': {
                 'splitFiles': {
                     t['name']: [k for k in t.keys() if k != 'name']
-                    for t in self.thread_table.get_items()
+                    for t in threads
                 },
                 'usageHoursByDate': self.usage_hours_by_date,
                 'uuid': self.config['uuid'],
@@ -440,25 +890,31 @@ class ProfileProcessor(object):
                     for k, v in self.process_thread(t).iteritems()
                     if k != 'name'
                 ]
-                for t in self.thread_table.get_items()
+                for t in threads
             ]
         }
 
+    def process_threads(self):
+        return [self.process_thread(t) for t in self.get_output_threads()]
+
     def process_into_profile(self):
         print "Processing into final format..."
-        if self.config['split_threads_in_out_file']:
-            return [
-                {
-                    'name': t['name'],
-                    'threads': [self.process_thread(t)],
-                    'usageHoursByDate': self.usage_hours_by_date,
-                    'uuid': self.config['uuid'],
-                }
-                for t in self.thread_table.get_items()
-            ]
+        return assemble_profile(self.process_threads(), self.usage_hours_by_date, self.config)
+
+def assemble_profile(processed_threads, usage_hours_by_date, config):
+    if config['split_threads_in_out_file']:
+        return [
+            {
+                'name': t['name'],
+                'threads': [t],
+                'usageHoursByDate': usage_hours_by_date,
+                'uuid': config['uuid'],
+            }
+            for t in processed_threads
+        ]
 
-        return {
-            'threads': [self.process_thread(t) for t in self.thread_table.get_items()],
-            'usageHoursByDate': self.usage_hours_by_date,
-            'uuid': self.config['uuid'],
-        }
+    return {
+        'threads': processed_threads,
+        'usageHoursByDate': usage_hours_by_date,
+        'uuid': config['uuid'],
+    }
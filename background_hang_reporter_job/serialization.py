@@ -0,0 +1,438 @@
+import contextlib
+import gzip
+import re
+import shutil
+import struct
+import sys
+from array import array
+
+import ujson as json
+
+from background_hang_reporter_job.profile import FloatColumn, to_json_compatible
+
+NAN = float('nan')
+
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# S3 rejects multipart uploads with parts (other than the last) under 5MB.
+MIN_S3_PART_SIZE = 5 * 1024 * 1024
+
+def encode_key(key):
+    # Same coercion as json.dumps for non-string keys.
+    if isinstance(key, basestring):
+        return json.dumps(key, ensure_ascii=False)
+    return json.dumps(json.dumps(key))
+
+def is_container(obj):
+    if isinstance(obj, dict):
+        return True
+    return (isinstance(obj, (list, tuple)) and obj and
+            isinstance(obj[0], (dict, list, tuple, array, FloatColumn)))
+
+class JSONStreamWriter(object):
+    """Writes a profile as JSON to a file-like object, one column at a time.
+
+    Dicts and lists of containers are walked, everything else (columns,
+    scalars) is encoded on its own. The output is the same document
+    json.dumps(to_json_compatible(obj)) would produce.
+    """
+    def __init__(self, out, buffer_size=WRITE_BUFFER_SIZE):
+        self.out = out
+        self.buffer_size = buffer_size
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, chunk):
+        self.pending.append(chunk)
+        self.pending_size += len(chunk)
+        if self.pending_size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            self.out.write(''.join(self.pending))
+            self.pending = []
+            self.pending_size = 0
+
+    def dump(self, obj):
+        self.write_value(obj)
+        self.flush()
+
+    def write_value(self, obj):
+        if not is_container(obj):
+            self.write(json.dumps(to_json_compatible(obj), ensure_ascii=False))
+        elif isinstance(obj, dict):
+            self.write('{')
+            for i, (key, value) in enumerate(obj.iteritems()):
+                if i:
+                    self.write(',')
+                self.write(encode_key(key))
+                self.write(':')
+                self.write_value(value)
+            self.write('}')
+        else:
+            self.write('[')
+            for i, value in enumerate(obj):
+                if i:
+                    self.write(',')
+                self.write_value(value)
+            self.write(']')
+
+# Structural characters, and the rest of a string after its opening quote.
+JSON_TOKEN_REGEX = re.compile(r'[\[\]{}"]')
+JSON_STRING_END_REGEX = re.compile(r'[^"\\]*(?:\\.[^"\\]*)*"', re.S)
+
+class LazyJSONProfile(object):
+    """Parses a profile's threads one at a time from chunks of its JSON text.
+
+    Only the thread being parsed is held in memory. Everything besides the
+    threads is available as `other` once iter_threads is exhausted.
+    """
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.other = None
+        # Scanner state: text outside the threads, the pieces of the thread
+        # being read, and where in the document the scanner is.
+        self.rest = []
+        self.thread_pieces = None
+        self.in_threads = False
+        self.depth = 0
+        self.last_string = None
+
+    def iter_threads(self):
+        buf = ''
+        for chunk in self.chunks:
+            threads, buf = self.scan(buf + chunk)
+            for thread in threads:
+                yield json.loads(thread)
+
+        self.rest.append(buf)
+        self.other = json.loads(''.join(self.rest))
+
+    def scan(self, buf):
+        # Hands as much of buf as can be tokenized to rest or thread_pieces.
+        # Returns the text of the threads completed along the way, and the
+        # remainder of buf, which continues in the next chunk.
+        completed = []
+        # Text before start has already been handed to rest or thread_pieces.
+        start = 0
+        pos = 0
+        while True:
+            match = JSON_TOKEN_REGEX.search(buf, pos)
+            if match is None:
+                pos = len(buf)
+                break
+            i = match.start()
+            if buf[i] == '"':
+                string_end = JSON_STRING_END_REGEX.match(buf, i + 1)
+                if string_end is None:
+                    # The string continues in the next chunk.
+                    pos = i
+                    break
+                if self.depth == 1:
+                    self.last_string = buf[i:string_end.end()]
+                pos = string_end.end()
+                continue
+
+            pos = i + 1
+            start = self.scan_bracket(buf, i, start, completed)
+
+        if self.thread_pieces is not None:
+            self.thread_pieces.append(buf[start:pos])
+        elif not self.in_threads:
+            self.rest.append(buf[start:pos])
+        return completed, buf[pos:]
+
+    def scan_bracket(self, buf, i, start, completed):
+        # Handles the bracket at buf[i], returning the new start.
+        c = buf[i]
+        if c == '[' or c == '{':
+            if self.depth == 1 and c == '[' and self.last_string == '"threads"':
+                self.rest.append(buf[start:i + 1])
+                start = i + 1
+                self.in_threads = True
+            elif self.in_threads and self.depth == 2 and c == '{':
+                # Drops the separator after the previous thread.
+                start = i
+                self.thread_pieces = []
+            self.depth += 1
+        else:
+            self.depth -= 1
+            if self.thread_pieces is not None and self.depth == 2:
+                self.thread_pieces.append(buf[start:i + 1])
+                start = i + 1
+                completed.append(''.join(self.thread_pieces))
+                self.thread_pieces = None
+            elif self.in_threads and self.depth == 1:
+                self.in_threads = False
+                start = i
+        return start
+
+class S3MultipartUpload(object):
+    """A write-only file-like object that uploads what's written to it as the
+    parts of an S3 multipart upload.
+    """
+    def __init__(self, client, bucket, key, part_size, **extra_args):
+        self.client = client
+        self.part_size = max(part_size, MIN_S3_PART_SIZE)
+        self.pending = []
+        self.pending_size = 0
+        self.parts = []
+        response = client.create_multipart_upload(Bucket=bucket, Key=key, **extra_args)
+        # Identifies the upload in every later request.
+        self.upload = {'Bucket': bucket, 'Key': key, 'UploadId': response['UploadId']}
+
+    def write(self, data):
+        self.pending.append(data)
+        self.pending_size += len(data)
+        if self.pending_size >= self.part_size:
+            self.upload_part()
+
+    def flush(self):
+        pass
+
+    def upload_part(self):
+        part_number = len(self.parts) + 1
+        response = self.client.upload_part(PartNumber=part_number,
+                                           Body=''.join(self.pending),
+                                           **self.upload)
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self.pending = []
+        self.pending_size = 0
+
+    def complete(self):
+        if self.pending or not self.parts:
+            self.upload_part()
+        self.client.complete_multipart_upload(MultipartUpload={'Parts': self.parts},
+                                              **self.upload)
+
+    def abort(self):
+        self.client.abort_multipart_upload(**self.upload)
+
+class TeeWriter(object):
+    def __init__(self, *outs):
+        self.outs = outs
+
+    def write(self, data):
+        for out in self.outs:
+            out.write(data)
+
+    def flush(self):
+        for out in self.outs:
+            out.flush()
+
+def write_gzipped_json(obj, filename, upload=None):
+    # Compresses once, writing the same gzip stream to the local file and, if
+    # given, to an S3MultipartUpload.
+    with open(filename, 'wb') as f:
+        out = f if upload is None else TeeWriter(f, upload)
+        gz = gzip.GzipFile(filename=filename, mode='wb', fileobj=out)
+        try:
+            JSONStreamWriter(gz).dump(obj)
+        finally:
+            gz.close()
+
+# Binary profiles are a JSON header followed by the document's numeric columns
+# as little-endian typed arrays, each aligned to 8 bytes:
+#   magic, header length, header, padding, column data
+# The header is {"columns": [...], "document": ...}, where each column in the
+# document has been replaced by {COLUMN_KEY: index into columns}.
+BINARY_MAGIC = 'BHRCOL01'
+BINARY_HEADER = struct.Struct('<8sI')
+COLUMN_KEY = '__column__'
+# Shorter lists aren't worth the indirection.
+MIN_BINARY_COLUMN_LENGTH = 8
+COLUMN_ALIGNMENT = 8
+
+# How None is stored, per column type. Float columns use NaN.
+INT_NULL = -2 ** 31
+BOOL_NULL = -1
+INT_MAX = 2 ** 31 - 1
+
+def get_padding(length):
+    return -length % COLUMN_ALIGNMENT
+
+def get_column_type(values):
+    # 'b', 'i' or 'd' if every value fits in a column of that type, else None.
+    column_type = None
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value_type = 'b'
+        elif isinstance(value, (int, long)):
+            if not INT_NULL < value <= INT_MAX:
+                return None
+            value_type = 'i'
+        elif isinstance(value, float):
+            value_type = 'd'
+        else:
+            return None
+        if column_type is None or column_type == value_type:
+            column_type = value_type
+        elif set((column_type, value_type)) == set(('i', 'd')):
+            column_type = 'd'
+        else:
+            return None
+    return column_type
+
+def delta_encode(values):
+    deltas = array('i')
+    previous = 0
+    for value in values:
+        delta = value - previous
+        if not INT_NULL < delta <= INT_MAX:
+            return None
+        deltas.append(delta)
+        previous = value
+    return deltas
+
+def encode_column(values, column_type, use_delta):
+    if column_type == 'd':
+        return array('d', [NAN if v is None else v for v in values]), False
+    if column_type == 'b':
+        return array('b', [BOOL_NULL if v is None else int(v) for v in values]), False
+    if use_delta and None not in values:
+        deltas = delta_encode(values)
+        if deltas is not None:
+            return deltas, True
+    return array('i', [INT_NULL if v is None else v for v in values]), False
+
+def extract_columns(obj, columns, use_delta):
+    if isinstance(obj, dict):
+        return {k: extract_columns(v, columns, use_delta) for k, v in obj.iteritems()}
+    if isinstance(obj, (array, FloatColumn)):
+        obj = to_json_compatible(obj)
+    if isinstance(obj, (list, tuple)):
+        if len(obj) >= MIN_BINARY_COLUMN_LENGTH:
+            column_type = get_column_type(obj)
+            if column_type is not None:
+                data, delta_encoded = encode_column(obj, column_type, use_delta)
+                columns.append((column_type, delta_encoded, data))
+                return {COLUMN_KEY: len(columns) - 1}
+        return [extract_columns(v, columns, use_delta) for v in obj]
+    return obj
+
+def write_binary_profile(obj, out, use_delta=True):
+    columns = []
+    document = extract_columns(obj, columns, use_delta)
+
+    column_infos = []
+    offset = 0
+    for column_type, delta_encoded, data in columns:
+        column_infos.append({
+            'type': column_type,
+            'length': len(data),
+            'offset': offset,
+            'delta': delta_encoded,
+        })
+        size = len(data) * data.itemsize
+        offset += size + get_padding(size)
+
+    header = json.dumps({'columns': column_infos, 'document': document}, ensure_ascii=False)
+    if isinstance(header, unicode):
+        header = header.encode('utf-8')
+    out.write(BINARY_HEADER.pack(BINARY_MAGIC, len(header)))
+    out.write(header)
+    out.write('\0' * get_padding(BINARY_HEADER.size + len(header)))
+
+    for _, _, data in columns:
+        if sys.byteorder != 'little':
+            data.byteswap()
+        out.write(data.tostring())
+        out.write('\0' * get_padding(len(data) * data.itemsize))
+
+def read_file_range(f, start, length):
+    f.seek(start)
+    return f.read(length)
+
+def read_binary_header(read):
+    # read(start, length) returns that range of the binary profile.
+    magic, header_length = BINARY_HEADER.unpack(read(0, BINARY_HEADER.size))
+    if magic != BINARY_MAGIC:
+        raise ValueError('Not a binary profile')
+    header = json.loads(read(BINARY_HEADER.size, header_length))
+    data_start = BINARY_HEADER.size + header_length
+    data_start += get_padding(data_start)
+    return header, data_start
+
+def decode_column(read, data_start, column_info):
+    column_type = column_info['type']
+    data = array(column_type)
+    data.fromstring(read(data_start + column_info['offset'],
+                         column_info['length'] * data.itemsize))
+    if sys.byteorder != 'little':
+        data.byteswap()
+
+    if column_type == 'b':
+        return [None if v == BOOL_NULL else bool(v) for v in data]
+    if column_info['delta']:
+        total = 0
+        for i, delta in enumerate(data):
+            total += delta
+            data[i] = total
+        return data
+    if column_type == 'i':
+        if INT_NULL in data:
+            return [None if v == INT_NULL else v for v in data]
+        return data
+    if any(v != v for v in data):
+        return [None if v != v else v for v in data]
+    return data
+
+def restore_columns(obj, get_column):
+    if isinstance(obj, dict):
+        if len(obj) == 1 and COLUMN_KEY in obj:
+            return get_column(obj[COLUMN_KEY])
+        return {k: restore_columns(v, get_column) for k, v in obj.iteritems()}
+    if isinstance(obj, list):
+        return [restore_columns(v, get_column) for v in obj]
+    return obj
+
+def read_binary(read):
+    # Columns are copied out into arrays (or lists, if they have missing values).
+    header, data_start = read_binary_header(read)
+    columns = [decode_column(read, data_start, column_info) for column_info in header['columns']]
+    return restore_columns(header['document'], columns.__getitem__)
+
+def read_binary_profile(buf):
+    return read_binary(lambda start, length: buf[start:start + length])
+
+def read_binary_file(filename):
+    # Reads each column straight into its array, without holding the whole file.
+    with open(filename, 'rb') as f:
+        return read_binary(lambda start, length: read_file_range(f, start, length))
+
+class LazyBinaryProfile(object):
+    """Reads a local binary profile's threads one at a time.
+
+    Only the columns of the thread being read are loaded. Everything besides
+    the threads is available as `other` once iter_threads is exhausted.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.other = None
+
+    def iter_threads(self):
+        with open(self.filename, 'rb') as f:
+            read = lambda start, length: read_file_range(f, start, length)
+            header, data_start = read_binary_header(read)
+            column_infos = header['columns']
+            get_column = lambda index: decode_column(read, data_start, column_infos[index])
+
+            document = header['document']
+            threads = document.pop('threads', [])
+            for i in xrange(len(threads)):
+                thread = restore_columns(threads[i], get_column)
+                threads[i] = None
+                yield thread
+            self.other = restore_columns(document, get_column)
+
+def write_binary_file(obj, filename, use_delta=True):
+    with open(filename, 'wb') as f:
+        write_binary_profile(obj, f, use_delta)
+
+def gzip_file(filename, gzfilename):
+    with open(filename, 'rb') as f:
+        with contextlib.closing(gzip.open(gzfilename, 'wb')) as gz:
+            shutil.copyfileobj(f, gz)
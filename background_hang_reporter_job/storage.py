@@ -0,0 +1,227 @@
+import gzip
+import os
+from datetime import datetime
+
+import ujson as json
+import boto3
+from boto3.s3.transfer import S3Transfer
+
+from background_hang_reporter_job.profile import to_json_compatible
+from background_hang_reporter_job.serialization import (LazyBinaryProfile, LazyJSONProfile,
+                                                        S3MultipartUpload, gzip_file,
+                                                        read_binary_file, read_binary_profile,
+                                                        write_binary_file, write_gzipped_json)
+from background_hang_reporter_job.symbol_cache import make_dirs
+from background_hang_reporter_job.symbolication import RESPONSE_CHUNK_SIZE, fetch_URL
+
+BINARY_EXTENSION = ".bhrc"
+
+def read_file(name, config):
+    end_date = datetime.today()
+    end_date_str = end_date.strftime("%Y%m%d")
+    # Prefer the binary format when it's being written.
+    binary = 'binary' in config['output_formats']
+    extension = BINARY_EXTENSION if binary else ".json"
+
+    if config['read_files_from_network']:
+        s3_key = "bhr/data/hang_aggregates/" + name + extension
+        url = config['analysis_output_url'] + s3_key
+        success, response = fetch_URL(url)
+        if not success:
+            raise Exception('Could not find file at url: ' + url)
+        if binary:
+            return read_binary_profile(response)
+        return json.loads(response)
+    else:
+        if config['append_date']:
+            filename = "./output/%s-%s%s" % (name, end_date_str, extension)
+        else:
+            filename = "./output/%s%s" % (name, extension)
+        if binary:
+            return read_binary_file(filename)
+        gzfilename = filename + '.gz'
+        with gzip.open(gzfilename, 'r') as f:
+            return json.loads(f.read())
+
+def get_local_filename(name, config):
+    # The local file read_file reads name from.
+    end_date = datetime.today()
+    end_date_str = end_date.strftime("%Y%m%d")
+    if 'binary' in config['output_formats']:
+        extension = BINARY_EXTENSION
+    else:
+        extension = ".json.gz"
+    if config['append_date']:
+        return "./output/%s-%s%s" % (name, end_date_str, extension)
+    return "./output/%s%s" % (name, extension)
+
+def file_exists(name, config):
+    if config['read_files_from_network']:
+        url = config['analysis_output_url'] + "bhr/data/hang_aggregates/" + name
+        url += BINARY_EXTENSION if 'binary' in config['output_formats'] else ".json"
+        success, _ = fetch_URL(url, lambda response: None)
+        return success
+    return os.path.exists(get_local_filename(name, config))
+
+def get_job_filename(name):
+    return "./output/%s.job.json" % name
+
+def write_job_file(name, job, config):
+    # Records the settings the file name was computed with, next to it.
+    filename = get_job_filename(name)
+    make_dirs('./output')
+    with open(filename, 'w') as f:
+        f.write(json.dumps(job))
+
+    if config['use_s3']:
+        transfer = S3Transfer(boto3.client('s3', 'us-west-2'))
+        transfer.upload_file(filename,
+                             "telemetry-public-analysis-2",
+                             "bhr/data/hang_aggregates/" + name + ".job.json",
+                             extra_args={'ContentType':'application/json'})
+
+def read_job_file(name, config):
+    # The settings write_job_file recorded for name, or None if there are none.
+    if config['read_files_from_network']:
+        url = config['analysis_output_url'] + "bhr/data/hang_aggregates/" + name + ".job.json"
+        success, response = fetch_URL(url)
+        return json.loads(response) if success else None
+    filename = get_job_filename(name)
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.loads(f.read())
+
+def iter_gzip_file_chunks(filename, chunk_size=RESPONSE_CHUNK_SIZE):
+    with gzip.open(filename, 'r') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+def ingest_file_lazily(profile_processor, name, config):
+    # Only local files are read lazily.
+    if config['read_files_from_network']:
+        profile_processor.ingest_processed_profile(read_file(name, config))
+        return
+
+    filename = get_local_filename(name, config)
+    if 'binary' in config['output_formats']:
+        profile = LazyBinaryProfile(filename)
+    else:
+        profile = LazyJSONProfile(iter_gzip_file_chunks(filename))
+    profile_processor.ingest_processed_threads(profile.iter_threads())
+    profile_processor.ingest_usage_hours(profile.other.get('usageHoursByDate', {}))
+
+def write_file(name, stuff, config):
+    for output_format in config['output_formats']:
+        if output_format == 'binary':
+            write_binary_output(name, stuff, config)
+        elif output_format == 'json':
+            write_json_output(name, stuff, config)
+        else:
+            raise Exception('Unknown output format: ' + output_format)
+
+def write_binary_output(name, stuff, config):
+    end_date = datetime.today()
+    end_date_str = end_date.strftime("%Y%m%d")
+
+    if config['append_date']:
+        filename = "./output/%s-%s%s" % (name, end_date_str, BINARY_EXTENSION)
+    else:
+        filename = "./output/%s%s" % (name, BINARY_EXTENSION)
+
+    make_dirs('./output')
+    write_binary_file(stuff, filename, config['binary_delta_encoding'])
+
+    if config['use_s3']:
+        # Kept uncompressed locally so it can be mmapped, but served gzipped.
+        gzfilename = filename + '.gz'
+        gzip_file(filename, gzfilename)
+        bucket = "telemetry-public-analysis-2"
+        s3_key = "bhr/data/hang_aggregates/" + name + BINARY_EXTENSION
+        client = boto3.client('s3', 'us-west-2')
+        transfer = S3Transfer(client)
+        extra_args = {'ContentType':'application/octet-stream', 'ContentEncoding':'gzip'}
+        transfer.upload_file(gzfilename,
+                             bucket,
+                             s3_key,
+                             extra_args=extra_args)
+        if config['uuid'] is not None:
+            s3_uuid_key = ("bhr/data/hang_aggregates/" + name + "_" + config['uuid'] +
+                           BINARY_EXTENSION)
+            transfer.upload_file(gzfilename,
+                                 bucket,
+                                 s3_uuid_key,
+                                 extra_args=extra_args)
+
+def write_json_output(name, stuff, config):
+    end_date = datetime.today()
+    end_date_str = end_date.strftime("%Y%m%d")
+
+    if config['append_date']:
+        filename = "./output/%s-%s.json" % (name, end_date_str)
+    else:
+        filename = "./output/%s.json" % name
+    gzfilename = filename + '.gz'
+
+    make_dirs('./output')
+
+    bucket = "telemetry-public-analysis-2"
+    s3_key = "bhr/data/hang_aggregates/" + name + ".json"
+    extra_args = {'ContentType':'application/json', 'ContentEncoding':'gzip'}
+    if config['use_s3'] and config['stream_s3_upload']:
+        client = boto3.client('s3', 'us-west-2')
+        upload = S3MultipartUpload(client, bucket, s3_key,
+                                   config['s3_upload_part_size'], **extra_args)
+        try:
+            write_gzipped_json(stuff, gzfilename, upload)
+            upload.complete()
+        except:
+            upload.abort()
+            raise
+        if config['uuid'] is not None:
+            s3_uuid_key = "bhr/data/hang_aggregates/" + name + "_" + config['uuid'] + ".json"
+            client.copy_object(Bucket=bucket,
+                               Key=s3_uuid_key,
+                               CopySource={'Bucket': bucket, 'Key': s3_key},
+                               MetadataDirective='REPLACE',
+                               **extra_args)
+        return
+
+    if config['streaming_json_output']:
+        write_gzipped_json(stuff, gzfilename)
+    else:
+        jsonblob = json.dumps(to_json_compatible(stuff), ensure_ascii=False)
+        with gzip.open(gzfilename, 'w') as f:
+            f.write(jsonblob)
+
+    if config['use_s3']:
+        client = boto3.client('s3', 'us-west-2')
+        transfer = S3Transfer(client)
+        transfer.upload_file(gzfilename,
+                             bucket,
+                             s3_key,
+                             extra_args=extra_args)
+        if config['uuid'] is not None:
+            s3_uuid_key = "bhr/data/hang_aggregates/" + name + "_" + config['uuid'] + ".json"
+            transfer.upload_file(gzfilename,
+                                 bucket,
+                                 s3_uuid_key,
+                                 extra_args=extra_args)
+
+def evict_incremental_files(name, oldest_date):
+    # Removes local incremental files, and their job files, for days before
+    # oldest_date.
+    if not os.path.exists('./output'):
+        return
+    prefix = name + "_incremental_"
+    oldest_date_str = oldest_date.strftime("%Y%m%d")
+    for filename in os.listdir('./output'):
+        if not filename.startswith(prefix):
+            continue
+        date_str = filename[len(prefix):len(prefix) + 8]
+        if date_str.isdigit() and date_str < oldest_date_str:
+            print "Evicting {}".format(filename)
+            os.remove(os.path.join('./output', filename))
@@ -0,0 +1,177 @@
+import errno
+import hashlib
+import os
+import struct
+import tempfile
+import time
+
+from background_hang_reporter_job.symbol_index import SymbolIndex
+
+CACHE_FILE_SUFFIX = ".symidx"
+MISSING_FILE_SUFFIX = ".missing"
+MISSING_SUBDIRECTORY = "missing"
+
+# Eviction walks the whole cache directory, so only do it once we've written
+# a decent fraction of the size budget since the last time.
+EVICTION_WRITE_FRACTION = 0.1
+
+def get_cache_key(module):
+    debug_name, breakpad_id = module
+    key = u"{}/{}".format(debug_name, breakpad_id).encode('utf-8')
+    return hashlib.sha1(key).hexdigest()
+
+def make_dirs(path):
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+def remove_if_exists(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+class SymbolCache(object):
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.bytes_since_eviction = 0
+        if not os.path.exists(cache_dir):
+            make_dirs(cache_dir)
+        self.evict()
+
+    def get_path(self, module):
+        key = get_cache_key(module)
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_FILE_SUFFIX)
+
+    def get(self, module):
+        path = self.get_path(module)
+        try:
+            index = SymbolIndex.from_file(path)
+        except (IOError, EnvironmentError):
+            return None
+        except (ValueError, struct.error):
+            # A truncated or corrupt entry. Drop it so it gets rebuilt.
+            print "Removing corrupt symbol cache entry {}".format(path)
+            try:
+                remove_if_exists(path)
+            except OSError:
+                pass
+            return None
+        try:
+            # Bump the mtime so eviction treats this entry as recently used.
+            os.utime(path, None)
+        except OSError:
+            pass
+        return index
+
+    def put(self, module, index):
+        # The cache is only an optimization, so failing to write to it (a full
+        # disk, say) shouldn't fail the task.
+        try:
+            self.write_entry(module, index)
+        except EnvironmentError as e:
+            print "Could not write symbol cache entry for {}: {}".format(module, e)
+
+    def write_entry(self, module, index):
+        path = self.get_path(module)
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            make_dirs(directory)
+
+        # Other executors may be reading from or writing to the same shared
+        # directory, so write to a temporary file and atomically rename it.
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(index.to_bytes())
+            os.rename(tmp_path, path)
+        except:
+            remove_if_exists(tmp_path)
+            raise
+
+        self.bytes_since_eviction += os.path.getsize(path)
+        if self.bytes_since_eviction > self.max_bytes * EVICTION_WRITE_FRACTION:
+            self.evict()
+
+    def evict(self):
+        self.bytes_since_eviction = 0
+        entries = []
+        total_bytes = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(CACHE_FILE_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            remove_if_exists(path)
+            total_bytes -= size
+            if total_bytes <= self.max_bytes:
+                break
+
+class MissingSymbolCache(object):
+    # Remembers symbol file URLs that 404'd, so we don't ask for them again
+    # until ttl seconds have passed. Each entry is an empty marker file whose
+    # mtime is the time of the failed request.
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        if not os.path.exists(cache_dir):
+            make_dirs(cache_dir)
+
+    def get_path(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        return os.path.join(self.cache_dir, key + MISSING_FILE_SUFFIX)
+
+    def contains(self, url):
+        path = self.get_path(url)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return False
+        if time.time() - mtime > self.ttl:
+            remove_if_exists(path)
+            return False
+        return True
+
+    def add(self, url):
+        with open(self.get_path(url), 'w'):
+            pass
+
+_symbol_caches = {}
+_missing_symbol_caches = {}
+
+# Executors are long-lived Python workers, so the cache object (and its eviction
+# bookkeeping) is shared by every task that runs in the same process.
+def get_symbol_cache(config):
+    cache_dir = config['symbol_cache_dir']
+    if cache_dir is None:
+        return None
+
+    if cache_dir not in _symbol_caches:
+        _symbol_caches[cache_dir] = SymbolCache(cache_dir, config['symbol_cache_max_bytes'])
+    return _symbol_caches[cache_dir]
+
+def get_missing_symbol_cache(config):
+    cache_dir = config['symbol_cache_dir']
+    if cache_dir is None:
+        return None
+
+    if cache_dir not in _missing_symbol_caches:
+        _missing_symbol_caches[cache_dir] = MissingSymbolCache(
+            os.path.join(cache_dir, MISSING_SUBDIRECTORY), config['symbol_missing_ttl'])
+    return _missing_symbol_caches[cache_dir]
@@ -0,0 +1,202 @@
+import socket
+import time
+import urlparse
+from collections import deque
+
+import eventlet
+from eventlet.green import httplib
+from eventlet.queue import LightQueue, Empty
+
+from background_hang_reporter_job.symbol_cache import get_missing_symbol_cache
+
+MAX_REDIRECTS = 3
+
+class PooledResponse(object):
+    # Just enough of the urllib2 response interface for decode_response and
+    # iter_response_chunks.
+    def __init__(self, response):
+        self.response = response
+
+    def getcode(self):
+        return self.response.status
+
+    def info(self):
+        return self.response.msg
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+class FetchError(Exception):
+    pass
+
+class ConnectionPool(object):
+    def __init__(self, max_idle_per_host, timeout):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self.idle = {}
+
+    def acquire(self, scheme, netloc):
+        queue = self.idle.get((scheme, netloc))
+        if queue is not None:
+            try:
+                return queue.get_nowait()
+            except Empty:
+                pass
+        #pylint: disable=no-member
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def release(self, scheme, netloc, connection):
+        queue = self.idle.setdefault((scheme, netloc), LightQueue())
+        if queue.qsize() >= self.max_idle_per_host:
+            connection.close()
+        else:
+            queue.put(connection)
+
+class CircuitBreaker(object):
+    # Opens once the error rate over the last `window` requests reaches
+    # `error_rate`, failing every request for `cooldown` seconds. After that a
+    # single trial request is let through; its outcome closes or reopens it.
+    # allow() hands out a ticket per request so that requests which were
+    # already in flight when the breaker opened can't be mistaken for the trial.
+    def __init__(self, window, error_rate, cooldown):
+        self.outcomes = deque(maxlen=window)
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.last_ticket = 0
+        self.trial = None
+
+    def allow(self):
+        # Returns a ticket for record and release, or None to reject the request.
+        if self.opened_at is not None:
+            if time.time() - self.opened_at < self.cooldown or self.trial is not None:
+                return None
+        self.last_ticket += 1
+        if self.opened_at is not None:
+            self.trial = self.last_ticket
+        return self.last_ticket
+
+    def record(self, ticket, success):
+        if self.opened_at is not None:
+            if ticket != self.trial:
+                return
+            self.trial = None
+            if success:
+                self.opened_at = None
+                self.outcomes.clear()
+            else:
+                self.opened_at = time.time()
+            return
+
+        self.outcomes.append(success)
+        if len(self.outcomes) == self.outcomes.maxlen:
+            errors = self.outcomes.count(False)
+            if float(errors) / len(self.outcomes) >= self.error_rate:
+                print "Symbol server error rate is too high, backing off for {}s".format(
+                    self.cooldown)
+                self.opened_at = time.time()
+
+    def release(self, ticket):
+        # A trial that ended without recording an outcome (because the caller
+        # raised) counts as a failure, so the next one waits out another cooldown.
+        if ticket is not None and ticket == self.trial:
+            self.trial = None
+            self.opened_at = time.time()
+
+class SymbolFetcher(object):
+    """Fetches URLs over pooled keep-alive connections with exponential backoff.
+
+    fetch has the same contract as symbolication.fetch_URL, so the two are
+    interchangeable in process_module. default_decode is used when fetch is
+    called without a decode callback.
+    """
+    def __init__(self, config, default_decode):
+        self.default_decode = default_decode
+        concurrency = config['symbol_fetch_concurrency']
+        self.pool = ConnectionPool(concurrency, config['symbol_fetch_timeout'])
+        self.retries = config['symbol_fetch_retries']
+        self.backoff = config['symbol_fetch_backoff']
+        self.breaker = CircuitBreaker(config['symbol_breaker_window'],
+                                      config['symbol_breaker_error_rate'],
+                                      config['symbol_breaker_cooldown'])
+        self.missing = get_missing_symbol_cache(config)
+
+    def request(self, url, decode):
+        for _ in xrange(MAX_REDIRECTS + 1):
+            parsed = urlparse.urlsplit(url)
+            path = parsed.path + ('?' + parsed.query if parsed.query else '')
+            connection = self.pool.acquire(parsed.scheme, parsed.netloc)
+            try:
+                connection.request('GET', path, headers={'Accept-Encoding': 'gzip'})
+                response = connection.getresponse()
+                status = response.status
+                if status in (301, 302, 303, 307, 308):
+                    location = response.getheader('Location')
+                    if location is None:
+                        # The handler below closes the connection instead of pooling it.
+                        raise FetchError('Redirect without a location: ' + url)
+                    response.read()
+                    self.pool.release(parsed.scheme, parsed.netloc, connection)
+                    url = urlparse.urljoin(url, location)
+                    continue
+                if status != 200:
+                    response.read()
+                    self.pool.release(parsed.scheme, parsed.netloc, connection)
+                    return status, None
+                result = decode(PooledResponse(response))
+                # Only hand the connection back if the body was fully consumed.
+                if response.isclosed() or not response.read():
+                    self.pool.release(parsed.scheme, parsed.netloc, connection)
+                else:
+                    connection.close()
+                return status, result
+            except:
+                connection.close()
+                raise
+        raise FetchError('Too many redirects: ' + url)
+
+    def fetch(self, url, decode=None):
+        if decode is None:
+            decode = self.default_decode
+
+        if self.missing is not None and self.missing.contains(url):
+            return False, ""
+
+        for attempt in xrange(self.retries + 1):
+            if attempt:
+                eventlet.sleep(self.backoff * (2 ** (attempt - 1)))
+            ticket = self.breaker.allow()
+            if ticket is None:
+                return False, ""
+            try:
+                try:
+                    status, result = self.request(url, decode)
+                #pylint: disable=no-member
+                except (IOError, socket.error, httplib.HTTPException, FetchError):
+                    self.breaker.record(ticket, False)
+                    continue
+                self.breaker.record(ticket, status < 500)
+            finally:
+                self.breaker.release(ticket)
+            if status == 200:
+                return True, result
+            if status < 500:
+                # 404s and other client errors won't go away by retrying.
+                if status == 404 and self.missing is not None:
+                    self.missing.add(url)
+                return False, ""
+        return False, ""
+
+_symbol_fetchers = {}
+
+# Like the symbol cache, a fetcher (and its idle connections) lives as long as
+# the executor's Python worker.
+def get_symbol_fetcher(config, default_decode):
+    key = tuple(config[k] for k in sorted(config)
+                if k.startswith('symbol_fetch_') or k.startswith('symbol_breaker_'))
+    key += (config['symbol_cache_dir'],)
+    if key not in _symbol_fetchers:
+        _symbol_fetchers[key] = SymbolFetcher(config, default_decode)
+    return _symbol_fetchers[key]
@@ -0,0 +1,127 @@
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect
+
+# Layout (all little-endian):
+#   header: magic, symbol count, blob length
+#   addresses: count * uint64, sorted
+#   offsets: (count + 1) * uint32, symbol i is blob[offsets[i]:offsets[i + 1]]
+#   blob: every symbol name, concatenated
+MAGIC = 'BHRSYM01'
+HEADER = struct.Struct('<8sII')
+
+# array has no 'Q' typecode in Python 2; 'L' is 64 bits on the platforms we run on.
+ADDRESS_TYPECODE = 'L'
+OFFSET_TYPECODE = 'I'
+
+class PackedArray(object):
+    """Read-only sequence view over packed integers, good enough for bisect."""
+    def __init__(self, buf, start, length, item_format):
+        self.buf = buf
+        self.start = start
+        self.length = length
+        self.item = struct.Struct('<' + item_format)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if index < 0 or index >= self.length:
+            raise IndexError(index)
+        return self.item.unpack_from(self.buf, self.start + index * self.item.size)[0]
+
+class SymbolIndex(object):
+    def __init__(self, buf):
+        magic, count, blob_length = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a symbol index')
+        self.buf = buf
+        addresses_start = HEADER.size
+        offsets_start = addresses_start + count * 8
+        self.blob_start = offsets_start + (count + 1) * 4
+        if len(buf) < self.blob_start + blob_length:
+            raise ValueError('Truncated symbol index')
+        self.addresses = PackedArray(buf, addresses_start, count, 'Q')
+        self.offsets = PackedArray(buf, offsets_start, count + 1, 'I')
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def symbol_at(self, i):
+        start = self.blob_start + self.offsets[i]
+        end = self.blob_start + self.offsets[i + 1]
+        return self.buf[start:end]
+
+    def lookup(self, address):
+        i = bisect(self.addresses, address)
+        if not i:
+            return None
+        return self.symbol_at(i - 1)
+
+    def to_bytes(self):
+        return self.buf[:]
+
+    @staticmethod
+    def from_file(path):
+        with open(path, 'rb') as f:
+            return SymbolIndex(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def pack_array(values, item_format):
+    if values.itemsize != struct.calcsize(item_format) or sys.byteorder != 'little':
+        return struct.pack('<%d%s' % (len(values), item_format), *values)
+    return values.tostring()
+
+class SymbolIndexBuilder(object):
+    """Accumulates parsed symbols in flat arrays, so memory stays close to the
+    size of the final index instead of a Python object per symbol."""
+    def __init__(self):
+        self.addresses = array(ADDRESS_TYPECODE)
+        self.priorities = bytearray()
+        self.offsets = array(OFFSET_TYPECODE, [0])
+        self.blob = bytearray()
+
+    def append(self, address, symbol, priority):
+        self.addresses.append(address)
+        self.priorities.append(priority)
+        self.blob += symbol
+        self.offsets.append(len(self.blob))
+
+    def build(self):
+        addresses = self.addresses
+        priorities = self.priorities
+        offsets = self.offsets
+        blob = self.blob
+
+        # When several symbols share an address, keep the one with the highest priority.
+        # Priorities are 0 or 1, so fold them into a single integer sort key.
+        order = array(OFFSET_TYPECODE, xrange(len(addresses)))
+        order = array(OFFSET_TYPECODE,
+                      sorted(order, key=lambda i: (addresses[i] << 1) | priorities[i]))
+
+        kept_addresses = array(ADDRESS_TYPECODE)
+        kept = array(OFFSET_TYPECODE)
+        for i in order:
+            if kept and kept_addresses[-1] == addresses[i]:
+                kept[-1] = i
+            else:
+                kept_addresses.append(addresses[i])
+                kept.append(i)
+        del order
+
+        kept_offsets = array(OFFSET_TYPECODE, [0])
+        kept_blob = bytearray()
+        for i in kept:
+            kept_blob += buffer(blob, offsets[i], offsets[i + 1] - offsets[i])
+            kept_offsets.append(len(kept_blob))
+
+        count = len(kept)
+        return SymbolIndex(''.join([
+            HEADER.pack(MAGIC, count, len(kept_blob)),
+            pack_array(kept_addresses, 'Q'),
+            pack_array(kept_offsets, 'I'),
+            str(kept_blob),
+        ]))
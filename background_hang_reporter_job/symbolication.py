@@ -0,0 +1,290 @@
+import contextlib
+import gzip
+import threading
+import urllib
+import urllib2
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from StringIO import StringIO
+
+import eventlet
+
+from background_hang_reporter_job.symbol_cache import get_symbol_cache
+from background_hang_reporter_job.symbol_fetcher import get_symbol_fetcher
+from background_hang_reporter_job.symbol_index import SymbolIndexBuilder
+
+UNSYMBOLICATED = "<unsymbolicated>"
+RESPONSE_CHUNK_SIZE = 1024 * 1024
+
+def parse_sym_line(line):
+    # Returns (address, symbol, priority), prioritizing PUBLIC symbols over FUNC ones
+    if line.startswith("PUBLIC "):
+        line = line.rstrip()
+        fields = line.split(" ", 3)
+        if len(fields) < 4:
+            return None
+        return int(fields[1], 16), fields[3], 1
+    elif line.startswith("FUNC "):
+        line = line.rstrip()
+        fields = line.split(" ", 4)
+        if len(fields) < 5:
+            return None
+        return int(fields[1], 16), fields[4], 0
+    return None
+
+def make_sym_map(data):
+    builder = SymbolIndexBuilder()
+    # Iterate rather than splitlines() so the whole file is never duplicated as a list.
+    for line in StringIO(data):
+        parsed = parse_sym_line(line)
+        if parsed is not None:
+            builder.append(*parsed)
+    return builder.build()
+
+def symbolicate_sym_lines(lines, addresses):
+    # Resolves the sorted, unique addresses against the lines of a .sym file in a
+    # single pass, keeping only the best candidate for each requested address.
+    # .sym files aren't globally sorted (PUBLIC lines come after FUNC lines), so
+    # each symbol is bucketed under the first requested address at or above it,
+    # and buckets are merged forward once the file has been consumed.
+    best = [None] * len(addresses)
+    for line in lines:
+        parsed = parse_sym_line(line)
+        if parsed is None:
+            continue
+        address, _, priority = parsed
+        i = bisect_left(addresses, address)
+        if i == len(addresses):
+            continue
+        current = best[i]
+        if current is None or (address, priority) >= (current[0], current[2]):
+            best[i] = parsed
+
+    result = []
+    last = None
+    for candidate in best:
+        if candidate is not None:
+            last = candidate
+        result.append(None if last is None else last[1])
+    return result
+
+def stream_module_symbols(module, offsets, config, fetch=None):
+    file_URL = get_file_URL(module, config)
+    if not file_URL:
+        return None
+
+    addresses = sorted(set(int(offset, 16) for offset in offsets))
+    success, symbols = (fetch or fetch_URL)(file_URL, lambda response: symbolicate_sym_lines(
+        iter_lines(iter_response_chunks(response)), addresses))
+    if not success:
+        return None
+
+    symbols_by_address = dict(zip(addresses, symbols))
+    return [symbols_by_address[int(offset, 16)] for offset in offsets]
+
+def get_file_URL(module, config):
+    lib_name, breakpad_id = module
+    if lib_name is None or breakpad_id is None:
+        return None
+    if lib_name.endswith(".pdb"):
+        file_name = lib_name[:-4] + ".sym"
+    else:
+        file_name = lib_name + ".sym"
+
+    try:
+        return config['symbol_server_url'] + "/".join([
+            urllib.quote_plus(lib_name),
+            urllib.quote_plus(breakpad_id),
+            urllib.quote_plus(file_name)
+        ])
+    except KeyError:
+        # urllib throws with unicode strings. TODO: investigate why
+        # any of these values (lib_name, breakpad_id, file_name) would
+        # have unicode strings, or if this is just bad pings.
+        return None
+
+def get_module_symbols(module, config, fetch=None):
+    symbol_cache = get_symbol_cache(config)
+    if symbol_cache is not None:
+        cached = symbol_cache.get(module)
+        if cached is not None:
+            return cached
+
+    file_URL = get_file_URL(module, config)
+    if not file_URL:
+        return None
+    success, response = (fetch or fetch_URL)(file_URL)
+    if not success:
+        return None
+
+    symbol_index = make_sym_map(response)
+    if symbol_cache is not None:
+        symbol_cache.put(module, symbol_index)
+    return symbol_index
+
+def process_module(module, offsets, config, fetch=None):
+    if module[0] == 'pseudo':
+        return [((None, offset), (offset, '')) for offset in offsets]
+    module_name, breakpad_id = module
+
+    # Streaming only pays off when there is no cache to populate with the full index.
+    if config['streaming_symbolication'] and get_symbol_cache(config) is None:
+        symbols = stream_module_symbols(module, offsets, config, fetch)
+    else:
+        symbol_index = get_module_symbols(module, config, fetch)
+        if symbol_index is not None:
+            symbols = [symbol_index.lookup(int(offset, 16)) for offset in offsets]
+        else:
+            symbols = None
+
+    if symbols is None:
+        symbols = [None] * len(offsets)
+
+    result = []
+    for offset, symbol in zip(offsets, symbols):
+        if symbol is not None:
+            result.append(((breakpad_id, offset), (symbol, module_name)))
+        else:
+            result.append(((breakpad_id, offset), (UNSYMBOLICATED, module_name)))
+    return result
+
+def process_modules_partition(modules, config):
+    # Overlap symbol downloads within the partition, bounded by
+    # symbol_fetch_concurrency, over the executor's pooled connections. The
+    # fetcher also skips files known to be missing and backs off when the
+    # symbol server is failing.
+    fetcher = get_symbol_fetcher(config, decode_response)
+    pool = eventlet.GreenPool(config['symbol_fetch_concurrency'])
+    processed = pool.imap(lambda x: process_module(x[0], x[1], config, fetcher.fetch), modules)
+    for result in processed:
+        for item in result:
+            yield item
+
+def process_modules(sc, frames_by_module, config):
+    data = sc.parallelize(frames_by_module.iteritems())
+    return (data.mapPartitions(lambda modules: process_modules_partition(modules, config))
+            .collectAsMap())
+
+class KnownSymbols(object):
+    # Symbolicated frames kept on the driver for the length of a job, so that
+    # frames seen on an earlier day aren't symbolicated again. Days may be
+    # processed on several threads at once. Frames that couldn't be symbolicated
+    # aren't kept, so a failed download is retried on later days (files known to
+    # be missing are skipped by the fetcher), and only the max_entries most
+    # recently used frames are kept.
+    def __init__(self, max_entries):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.processed_modules = OrderedDict()
+
+    def process_modules(self, sc, frames_by_module, config):
+        known = {}
+        new_frames_by_module = {}
+        with self.lock:
+            for module, offsets in frames_by_module.iteritems():
+                new_offsets = []
+                for offset in offsets:
+                    key = (module[1], offset)
+                    if key in self.processed_modules:
+                        # Move it to the end, so it's evicted last.
+                        known[key] = self.processed_modules.pop(key)
+                        self.processed_modules[key] = known[key]
+                    else:
+                        new_offsets.append(offset)
+                if new_offsets:
+                    new_frames_by_module[module] = tuple(new_offsets)
+        print "{} of {} modules have frames that weren't symbolicated on earlier days".format(
+            len(new_frames_by_module), len(frames_by_module))
+
+        processed_modules = {}
+        if new_frames_by_module:
+            processed_modules = process_modules(sc, new_frames_by_module, config)
+        with self.lock:
+            for key, value in processed_modules.iteritems():
+                if value[0] != UNSYMBOLICATED:
+                    self.processed_modules[key] = value
+            while len(self.processed_modules) > self.max_entries:
+                self.processed_modules.popitem(last=False)
+        processed_modules.update(known)
+        return processed_modules
+
+def fetch_URL(url, decode=None):
+    # decode is called with the open response and defaults to reading the whole body.
+    if decode is None:
+        decode = decode_response
+
+    result = False, ""
+    try:
+        with contextlib.closing(urllib2.urlopen(url)) as response:
+            #pylint: disable=no-member
+            responseCode = response.getcode()
+            if responseCode == 404:
+                return False, ""
+            if responseCode != 200:
+                result = False, ""
+            return True, decode(response)
+    except IOError:
+        result = False, ""
+
+    if not result[0]:
+        try:
+            with contextlib.closing(urllib2.urlopen(url)) as response:
+                #pylint: disable=no-member
+                responseCode = response.getcode()
+                if responseCode == 404:
+                    return False, ""
+                if responseCode != 200:
+                    result = False, ""
+                return True, decode(response)
+        except IOError:
+            result = False, ""
+
+    return result
+
+def decode_response(response):
+    headers = response.info()
+    content_encoding = headers.get("Content-Encoding", "").lower()
+    if content_encoding in ("gzip", "x-gzip", "deflate"):
+        with contextlib.closing(StringIO(response.read())) as data_stream:
+            try:
+                with gzip.GzipFile(fileobj=data_stream) as f:
+                    return f.read()
+            except EnvironmentError:
+                #pylint: disable=no-member
+                data_stream.seek(0)
+                #pylint: disable=no-member
+                return data_stream.read().decode('zlib')
+    return response.read()
+
+def iter_response_chunks(response, chunk_size=RESPONSE_CHUNK_SIZE):
+    headers = response.info()
+    content_encoding = headers.get("Content-Encoding", "").lower()
+    decompressor = None
+    if content_encoding in ("gzip", "x-gzip", "deflate"):
+        # Accept both gzip and zlib headers, like decode_response does.
+        decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    while True:
+        chunk = response.read(chunk_size)
+        if not chunk:
+            break
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+        if chunk:
+            yield chunk
+
+    if decompressor is not None:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+def iter_lines(chunks):
+    pending = ""
+    for chunk in chunks:
+        lines = (pending + chunk).split("\n")
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
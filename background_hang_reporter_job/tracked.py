@@ -1,129 +1,72 @@
-class AllHangs(object):
-    title = "All Hangs"
-
-    @staticmethod
-    def matches_hang(_):
-        return True
-
-class DevtoolsHangs(object):
-    title = "Devtools Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "devtools/" in frame
-                                         for lib, frame in stack)
-
-class ToolboxHangs(object):
-    title = "Toolbox Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "toolbox.js" in frame
-                                         for lib, frame in stack)
-
-class NetmonitorHangs(object):
-    title = "Netmonitor Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "/netmonitor/" in frame
-                                         for lib, frame in stack)
-
-class NetmonitoriBatchingHangs(object):
-    title = "Netmonitor Batching Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "netmonitor/src/middleware/batching" in frame
-                                         for lib, frame in stack)
-
-class NetmonitoriSelectorsHangs(object):
-    title = "Netmonitor Selectors Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "netmonitor/src/selectors" in frame
-                                         for lib, frame in stack)
-
-class NetmonitoriComponentsHangs(object):
-    title = "Netmonitor Components Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "netmonitor/src/components" in frame
-                                         for lib, frame in stack)
-
-class NetmonitorBackendHangs(object):
-    title = "Netmonitor backend Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "/network-monitor.js" in frame
-                                         for lib, frame in stack)
-
-class ReactHangs(object):
-    title = "React Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "devtools/" in frame and "vendor/react" in frame
-                                         for lib, frame in stack)
-
-class ImmutableHangs(object):
-    title = "Immutable Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "devtools/" in frame and "vendor/immutable" in frame
-                                         for lib, frame in stack)
-
-class InspectorHangs(object):
-    title = "Inspector Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "/inspector/" in frame
-                                         for lib, frame in stack)
-
-class ConsoleHangs(object):
-    title = "Console Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "/webconsole/" in frame
-                                         for lib, frame in stack)
-
-class DebuggerHangs(object):
-    title = "Debugger Hangs"
-
-    @staticmethod
-    def matches_hang(hang):
-        #pylint: disable=unused-variable
-        stack, duration, thread, runnable, process, annotations, build_date, platform = hang
-        return stack is not None and any(frame is not None and "/debugger/" in frame
-                                         for lib, frame in stack)
+import re
+
+# (title, patterns). A hang counts towards a stat if any frame in its stack
+# contains every substring of at least one of the stat's patterns. A stat with
+# no patterns counts every hang.
+TRACKED_STATS = [
+    ("All Hangs", []),
+    ("Devtools Hangs", [("devtools/",)]),
+    ("Toolbox Hangs", [("toolbox.js",)]),
+    ("Netmonitor Hangs", [("/netmonitor/",)]),
+    ("Netmonitor Batching Hangs", [("netmonitor/src/middleware/batching",)]),
+    ("Netmonitor Selectors Hangs", [("netmonitor/src/selectors",)]),
+    ("Netmonitor Components Hangs", [("netmonitor/src/components",)]),
+    ("Netmonitor backend Hangs", [("/network-monitor.js",)]),
+    ("React Hangs", [("devtools/", "vendor/react")]),
+    ("Immutable Hangs", [("devtools/", "vendor/immutable")]),
+    ("Inspector Hangs", [("/inspector/",)]),
+    ("Console Hangs", [("/webconsole/",)]),
+    ("Debugger Hangs", [("/debugger/",)]),
+]
+
+class TrackedStat(object):
+    def __init__(self, title, patterns):
+        self.title = title
+        self.patterns = [tuple(p) for p in patterns]
+        self.matcher = None
+
+    def matches_hang(self, hang):
+        if self.matcher is None:
+            self.matcher = TrackedStatMatcher([self])
+        return bool(self.matcher.matching_stats(hang))
+
+class TrackedStatMatcher(object):
+    """Finds every tracked stat matching a hang in a single scan of its stack.
+
+    All substrings from all stats are compiled into one regex, which rejects
+    the vast majority of frames with a single search. Only frames it accepts
+    are checked against the individual substrings.
+    """
+    def __init__(self, stats):
+        self.always = frozenset(i for i, stat in enumerate(stats) if not stat.patterns)
+        self.patterns = [
+            (i, frozenset(pattern))
+            for i, stat in enumerate(stats)
+            for pattern in stat.patterns
+        ]
+        self.substrings = sorted(set(s for _, pattern in self.patterns for s in pattern))
+        if self.substrings:
+            self.regex = re.compile('|'.join(re.escape(s) for s in self.substrings))
+        else:
+            self.regex = None
+        self.num_stats = len(stats)
+
+    def matching_stats(self, hang):
+        stack = hang[0]
+        matched = set(self.always)
+        if stack is None or self.regex is None:
+            return matched
+
+        for _, frame in stack:
+            if frame is None or not self.regex.search(frame):
+                continue
+            present = set(s for s in self.substrings if s in frame)
+            for stat_index, pattern in self.patterns:
+                if pattern <= present:
+                    matched.add(stat_index)
+            if len(matched) == self.num_stats:
+                break
+        return matched
 
 def get_tracked_stats():
-    return [AllHangs, DevtoolsHangs, ToolboxHangs, NetmonitorHangs, NetmonitoriBatchingHangs, NetmonitoriSelectorsHangs, NetmonitoriComponentsHangs, NetmonitorBackendHangs, ReactHangs, ImmutableHangs, InspectorHangs, ConsoleHangs, DebuggerHangs]
+    return [TrackedStat(title, patterns) for title, patterns in TRACKED_STATS]